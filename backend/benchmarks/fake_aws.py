@@ -0,0 +1,126 @@
+"""
+Offline stand-ins for the AWS pieces lambda_function touches: an S3 client backed by a local
+directory, and a Lambda context with a wall-clock deadline.
+"""
+import datetime
+import io
+import os
+import shutil
+import threading
+import time
+
+class _NoSuchKey(Exception):
+    pass
+
+class FakeS3:
+    """
+    The subset of the boto3 S3 client used by lambda_function, storing objects as files under
+    root/<bucket>/<key>. Counts the bytes read and written so benchmarks can report transfer volume.
+    """
+    class exceptions:
+        NoSuchKey = _NoSuchKey
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.requests = 0
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _count(self, downloaded=0, uploaded=0):
+        with self._lock:
+            self.requests += 1
+            self.bytes_downloaded += downloaded
+            self.bytes_uploaded += uploaded
+
+    def _write(self, bucket, key, body):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        self._count(uploaded=len(body))
+
+    def _read(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            self._count()
+            raise _NoSuchKey(f"NoSuchKey: {bucket}/{key}")
+        with open(path, 'rb') as f:
+            body = f.read()
+        self._count(downloaded=len(body))
+        return body
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._write(Bucket, Key, Body if isinstance(Body, bytes) else Body.read())
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        return {'Body': io.BytesIO(self._read(Bucket, Key))}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        with open(Filename, 'rb') as f:
+            self._write(Bucket, Key, f.read())
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        self._write(Bucket, Key, Fileobj.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        body = self._read(Bucket, Key)
+        with open(Filename, 'wb') as f:
+            f.write(body)
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._write(Bucket, Key, self._read(CopySource['Bucket'], CopySource['Key']))
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            path = self._path(Bucket, obj['Key'])
+            if os.path.isfile(path):
+                os.remove(path)
+        self._count()
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._count()
+        contents = []
+        bucket_root = os.path.join(self.root, Bucket)
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    stat = os.stat(path)
+                    contents.append({'Key': key, 'Size': stat.st_size,
+                                     'LastModified': datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)})
+        return {'Contents': sorted(contents, key=lambda obj: obj['Key'])} if contents else {}
+
+    def get_paginator(self, operation):
+        client = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield getattr(client, operation)(**kwargs)
+        return Paginator()
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return f"https://fake-s3.local/{Params['Bucket']}/{Params['Key']}?method={ClientMethod}&expires={ExpiresIn}"
+
+    def reset(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def stats(self):
+        return {'requests': self.requests, 'bytes_downloaded': self.bytes_downloaded, 'bytes_uploaded': self.bytes_uploaded}
+
+class FakeLambdaContext:
+    """Lambda context whose remaining time counts down from timeout_s seconds after creation."""
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:000000000000:function:forest-classification-benchmark'
+
+    def __init__(self, timeout_s=900):
+        self._deadline = time.monotonic() + timeout_s
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
@@ -0,0 +1,294 @@
+"""
+Offline stand-in for the parts of the earthengine-api used by forest_classification.
+
+Every ee call builds a lazy Expr tree, like the real client library. getInfo() evaluates the tree
+locally with synthetic but self-consistent data (scene metadata, class histograms proportional to
+the region's area, protected areas covering part of the boundary), and getDownloadURL() returns a
+URL served by FakeTileAdapter, which renders synthetic class rasters with configurable latency,
+server errors and throttling.
+"""
+import datetime
+import io
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+import requests.structures
+from PIL import Image as PILImage
+from shapely import affinity
+from shapely.geometry import mapping, shape, Point
+
+TILE_URL = 'https://fake-ee.local/tiles'
+
+# Synthetic scene and land cover used for every evaluation
+CONFIG = {
+    's2_count': 6,
+    'dw_count': 12,
+    'cloud_cover': 0.4,
+    'scene_date': datetime.datetime(2024, 6, 7, tzinfo=datetime.timezone.utc),
+    'protected_fraction': 0.5,  # Linear scale of the boundary used as the protected area
+    'class_weights': [10, 30, 12, 2, 8, 15, 5, 4, 1, 0, 13],  # Relative frequency of class values 0-10
+}
+
+class EEException(Exception):
+    pass
+
+# --- Lazy expressions ---
+class Expr:
+    """A lazily evaluated Earth Engine object: a constructor (parent None) or a method call on parent."""
+    def __init__(self, op, args=(), kwargs=None, parent=None):
+        self.op = op
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.parent = parent
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: Expr(name, args, kwargs, self)
+
+    def getInfo(self):
+        return evaluate(self)
+
+    def getDownloadURL(self, params):
+        return f"{TILE_URL}?{urllib.parse.urlencode({'dimensions': params['dimensions']})}"
+
+class _Constructor:
+    """Callable namespace such as ee.Geometry, whose attributes are further constructors (ee.Geometry.Polygon)."""
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        return Expr(self.name, args, kwargs)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return _Constructor(f"{self.name}.{attr}")
+
+Image = _Constructor('Image')
+ImageCollection = _Constructor('ImageCollection')
+FeatureCollection = _Constructor('FeatureCollection')
+Feature = _Constructor('Feature')
+Geometry = _Constructor('Geometry')
+Dictionary = _Constructor('Dictionary')
+List = _Constructor('List')
+Number = _Constructor('Number')
+Date = _Constructor('Date')
+Filter = _Constructor('Filter')
+Reducer = _Constructor('Reducer')
+Algorithms = _Constructor('Algorithms')
+
+def Initialize(credentials=None, **kwargs):
+    pass
+
+def ServiceAccountCredentials(email, key_file=None, key_data=None):
+    return None
+
+class data:
+    """ee.data: every WDPA month exists except those listed in missing_assets."""
+    missing_assets = set()
+    update_time = '2024-01-01T00:00:00Z'  # Reported for every asset, as the 'current' release marker
+
+    @staticmethod
+    def getAsset(asset_id):
+        if asset_id in data.missing_assets:
+            raise EEException(f"Asset '{asset_id}' not found.")
+        return {'id': asset_id, 'type': 'TABLE', 'updateTime': data.update_time}
+
+# --- Evaluation ---
+SQUARE_METERS_PER_SQUARE_DEGREE = 111320.0 ** 2
+
+def evaluate(value):
+    """Compute the client-side value of an expression, recursing into containers."""
+    if isinstance(value, Expr):
+        return _evaluate_expr(value)
+    if isinstance(value, dict):
+        return {key: evaluate(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [evaluate(item) for item in value]
+    return value
+
+def _evaluate_expr(expr):
+    if expr.parent is None:
+        return _evaluate_constructor(expr)
+    op, args, kwargs = expr.op, expr.args, expr.kwargs
+
+    # Collections whose contents only matter for their size
+    if op == 'size':
+        return _collection_size(expr.parent)
+    if op == 'first':
+        return {
+            'CLOUDY_PIXEL_PERCENTAGE': CONFIG['cloud_cover'],
+            'system:time_start': int(CONFIG['scene_date'].timestamp() * 1000),
+        }
+    # Reductions only depend on the region, so the image being reduced is never evaluated
+    if op == 'reduceRegion':
+        return {'classification': synthetic_histogram(evaluate(kwargs.get('geometry')), kwargs.get('scale', 10))}
+    if op == 'reduceRegions':
+        features = evaluate(kwargs['collection'])
+        return [{**feature, 'properties': {**feature['properties'], 'histogram': synthetic_histogram(feature['geometry'], kwargs.get('scale', 10))}}
+                for feature in features]
+    if op in ('filterDate', 'filterBounds', 'filter', 'sort', 'dissolve', 'simplify', 'rename', 'clip', 'unmask', 'toUint8', 'byte'):
+        return evaluate(expr.parent)
+
+    parent = evaluate(expr.parent)
+    if op == 'get':
+        return parent.get(evaluate(args[0])) if isinstance(parent, dict) else None
+    if op == 'format':
+        return parent.strftime('%Y-%m-%d')
+    if op in ('gt', 'gte', 'lt', 'lte', 'eq', 'And', 'Or', 'divide', 'multiply'):
+        other = evaluate(args[0])
+        return {
+            'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b, 'lt': lambda a, b: a < b,
+            'lte': lambda a, b: a <= b, 'eq': lambda a, b: a == b, 'And': lambda a, b: bool(a and b),
+            'Or': lambda a, b: bool(a or b), 'divide': lambda a, b: a / b, 'multiply': lambda a, b: a * b,
+        }[op](parent, other)
+    if op == 'map':
+        return [evaluate(args[0](Expr('Constant', (item,)))) for item in parent]
+    if op == 'set':
+        properties = dict(parent.get('properties', {}))
+        properties[evaluate(args[0])] = evaluate(args[1])
+        return {**parent, 'properties': properties}
+    if op == 'geometry':
+        if isinstance(parent, dict) and 'geometry' in parent:
+            return parent['geometry']
+        return parent
+    if op == 'area':
+        return shape(parent).area * SQUARE_METERS_PER_SQUARE_DEGREE
+    if op == 'buffer':
+        return mapping(shape(parent).buffer(evaluate(args[0]) / 111320.0))
+    if op == 'intersection':
+        # The protected area is a shrunken copy of the boundary it is clipped to
+        boundary = shape(evaluate(args[0]))
+        fraction = CONFIG['protected_fraction']
+        return mapping(affinity.scale(boundary, fraction, fraction))
+    if op == 'select':
+        names = evaluate(args[0])
+        return {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {name: feature['properties'].get(name) for name in names}} for feature in parent
+        ]}
+    raise NotImplementedError(f"fake ee does not evaluate .{op}()")
+
+def _evaluate_constructor(expr):
+    op, args = expr.op, expr.args
+    if op == 'Algorithms.If':
+        condition, true_case, false_case = args
+        return evaluate(true_case) if evaluate(condition) else evaluate(false_case)
+    if op in ('Constant', 'Dictionary', 'List', 'Number', 'Image'):
+        return evaluate(args[0]) if args else None
+    if op == 'Date':
+        value = evaluate(args[0])
+        if isinstance(value, str):
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+        return datetime.datetime.fromtimestamp(value / 1000, tz=datetime.timezone.utc)
+    if op == 'Geometry':
+        return evaluate(args[0])
+    if op == 'Geometry.Polygon':
+        return {'type': 'Polygon', 'coordinates': evaluate(args[0])}
+    if op == 'Geometry.MultiPolygon':
+        return {'type': 'MultiPolygon', 'coordinates': evaluate(args[0])}
+    if op == 'Geometry.Point':
+        return mapping(Point(evaluate(args[0])))
+    if op == 'Feature':
+        properties = evaluate(args[1]) if len(args) > 1 else {}
+        return {'type': 'Feature', 'geometry': evaluate(args[0]), 'properties': properties}
+    if op == 'FeatureCollection':
+        return evaluate(args[0]) if isinstance(args[0], (list, tuple)) else {'id': args[0]}
+    if op == 'ImageCollection':
+        return {'id': args[0]}
+    raise NotImplementedError(f"fake ee does not evaluate ee.{op}()")
+
+def _collection_size(expr):
+    """Size of an image collection, taken from the dataset at the root of its filter chain."""
+    while expr.parent is not None:
+        expr = expr.parent
+    dataset = expr.args[0] if expr.args else ''
+    return CONFIG['dw_count'] if 'DYNAMICWORLD' in str(dataset) else CONFIG['s2_count']
+
+def synthetic_histogram(geometry, scale):
+    """Class frequency histogram of a region, with pixel counts proportional to its area at scale."""
+    pixels = shape(geometry).area * SQUARE_METERS_PER_SQUARE_DEGREE / (scale * scale)
+    weights = CONFIG['class_weights']
+    return {str(value): pixels * weight / sum(weights) for value, weight in enumerate(weights) if weight}
+
+# --- Tile server ---
+class FakeTileAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter that answers tile downloads with synthetic single-band class PNGs.
+    Each request waits latency_ms (with jitter), then fails with a 500 at error_rate, is throttled
+    with a 429 and Retry-After at throttle_rate, or returns the raster. Rendered PNGs are reused per
+    tile size so the fake server itself costs little.
+    """
+    def __init__(self, latency_ms=100, jitter_ms=20, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=0):
+        super().__init__()
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._png_cache = {}
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self._random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+            roll = self._random.random()
+        time.sleep(delay)
+
+        if roll < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return self._response(request, 500, b'Internal error')
+        if roll < self.error_rate + self.throttle_rate:
+            with self._lock:
+                self.throttled += 1
+            return self._response(request, 429, b'Too many requests', {'Retry-After': str(self.retry_after)})
+
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(request.url).query)
+        width, height = (int(side) for side in query['dimensions'][0].split('x'))
+        body = self._render(width, height)
+        with self._lock:
+            self.bytes_sent += len(body)
+        return self._response(request, 200, body, {'Content-Type': 'image/png'})
+
+    def _render(self, width, height):
+        """Blocky random class raster weighted like CONFIG['class_weights'], encoded as PNG."""
+        key = (width, height)
+        with self._lock:
+            if key in self._png_cache:
+                return self._png_cache[key]
+        weights = CONFIG['class_weights']
+        rng = random.Random(width * 100003 + height)
+        cells = PILImage.new('L', (max(1, width // 8), max(1, height // 8)))
+        cells.putdata(rng.choices(range(len(weights)), weights=weights, k=cells.width * cells.height))
+        buffer = io.BytesIO()
+        cells.resize((width, height), PILImage.NEAREST).save(buffer, format='PNG')
+        with self._lock:
+            self._png_cache[key] = buffer.getvalue()
+        return buffer.getvalue()
+
+    def _response(self, request, status_code, body, headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = body
+        response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        response.url = request.url
+        response.request = request
+        response.encoding = None
+        return response
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors, 'throttled': self.throttled, 'bytes_sent': self.bytes_sent}
@@ -0,0 +1,277 @@
+"""
+Offline benchmarks for the forest classification Lambda.
+
+Drives the real lambda_handler end to end with a fake Earth Engine (fake_ee) and a disk-backed
+fake S3 (fake_aws), so performance can be measured without a GEE account or AWS. Each scenario
+runs in its own process (module-level settings such as TILE_MAX_PIXELS are read at import, and
+peak RSS is per process) and reports latency percentiles, peak RSS and bytes transferred.
+
+    python backend/benchmarks/run.py                      # run every scenario, write results.json
+    python backend/benchmarks/run.py --save-baseline      # also store the results as baseline.json
+    python backend/benchmarks/run.py --compare            # exit 1 if a scenario regressed past --tolerance, 2 without a baseline
+    python backend/benchmarks/run.py --scenarios analysis-tiny-w10-t2048 --iterations 10 --throttle-rate 0.1
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BENCHMARK_DIR, '..', 'lambda')
+REPO_ROOT = os.path.join(BENCHMARK_DIR, '..', '..')
+FEATURE_COLLECTION_PATH = os.path.join(REPO_ROOT, 'wdecm032.geojson')
+DEFAULT_RESULTS_PATH = os.path.join(BENCHMARK_DIR, 'results.json')
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+BUCKET = 'forest-classification-benchmark'
+
+# --- Scenarios ---
+def boundary_upload(name):
+    """Upload JSON in the format the frontend sends: boundary WKT, its area in km² and its bounding box."""
+    from shapely.geometry import box, Point, shape
+    from shapely.ops import unary_union
+
+    if name == 'tiny':  # A small town, a handful of tiles
+        polygon = box(-105.0, 39.73, -104.98, 39.75)
+    elif name == 'city':  # A city-sized irregular boundary
+        polygon = Point(-104.95, 39.75).buffer(0.15)
+    elif name == 'region':  # The full extent of wdecm032.geojson
+        with open(FEATURE_COLLECTION_PATH) as f:
+            features = json.load(f)['features']
+        polygon = box(*unary_union([shape(feature['geometry']) for feature in features]).bounds)
+    else:
+        raise ValueError(f"Unknown boundary: {name}")
+
+    minx, miny, maxx, maxy = polygon.bounds
+    km_per_degree = 111.32
+    area_km2 = polygon.area * km_per_degree ** 2 * math.cos(math.radians((miny + maxy) / 2))
+    return {
+        'city_geometry': polygon.wkt,
+        'area': area_km2,
+        'bbox_west': minx, 'bbox_south': miny, 'bbox_east': maxx, 'bbox_north': maxy,
+    }
+
+def default_scenarios():
+    """
+    Analysis across boundary sizes, tile sizes and worker counts, the uncapped 'strips' and 'tiles'
+    output modes on the region, plus one batch analysis.
+    """
+    scenarios = []
+    for boundary in ('tiny', 'city', 'region'):
+        for workers in (4, 10):
+            for tile_side in (1024, 2048):
+                scenarios.append({
+                    'name': f"analysis-{boundary}-w{workers}-t{tile_side}",
+                    'operation': 'analysis',
+                    'boundary': boundary,
+                    'workers': workers,
+                    'tile_max_pixels': tile_side * tile_side,
+                    'output_mode': 'image',
+                })
+    for output_mode in ('strips', 'tiles'):
+        scenarios.append({
+            'name': f"analysis-region-{output_mode}",
+            'operation': 'analysis',
+            'boundary': 'region',
+            'workers': 10,
+            'tile_max_pixels': 2048 * 2048,
+            'output_mode': output_mode,
+        })
+    scenarios.append({
+        'name': 'batch-region-features',
+        'operation': 'batch_analysis',
+        'boundary': 'features',
+        'workers': 10,
+        'tile_max_pixels': 2048 * 2048,
+    })
+    return scenarios
+
+# --- Scenario process ---
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def peak_rss_mb():
+    """Peak resident set size of this process; ru_maxrss is in KiB on Linux and bytes on macOS."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def run_scenario(scenario, options, workdir):
+    """Import the Lambda against the fakes, invoke it options['iterations'] times and summarize. The fake S3 lives under workdir."""
+    os.environ.update({
+        'S3_BUCKET': BUCKET,
+        'ASSETS_BUCKET': BUCKET,
+        'EE_KEY_S3_KEY': 'credentials/ee-key.json',
+        'OUTPUT_PREFIX': 'forest_classification',
+        'UPLOAD_EXPIRATION': '3600',
+        'DOWNLOAD_EXPIRATION': '86400',
+        'ALLOWED_ORIGINS': '*',
+        'DEBUG': 'false',
+        'RESULT_CACHE_ENABLED': 'false',
+        'TILE_CACHE_MAX_BYTES': '0',
+        'METRICS_ENABLED': 'false',
+        'TILE_MAX_PIXELS': str(scenario['tile_max_pixels']),
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+    })
+    sys.path[:0] = [BENCHMARK_DIR, LAMBDA_DIR]
+    import fake_ee
+    from fake_aws import FakeS3, FakeLambdaContext
+    sys.modules['ee'] = fake_ee
+    import lambda_function
+    import forest_classification
+
+    s3 = FakeS3(os.path.join(workdir, 's3'))
+    s3.put_object(Bucket=BUCKET, Key='credentials/ee-key.json', Body=json.dumps({'client_email': 'benchmark@example.com'}).encode('utf-8'))
+    if scenario['boundary'] == 'features':
+        with open(FEATURE_COLLECTION_PATH, 'rb') as f:
+            upload = f.read()
+    else:
+        upload = json.dumps(boundary_upload(scenario['boundary'])).encode('utf-8')
+    s3.put_object(Bucket=BUCKET, Key='uploads/benchmark.json', Body=upload)
+
+    tiles = fake_ee.FakeTileAdapter(latency_ms=options['latency_ms'], error_rate=options['error_rate'],
+                                    throttle_rate=options['throttle_rate'], retry_after=options['retry_after'])
+    lambda_function.s3 = forest_classification.s3 = s3
+    forest_classification.TILE_WORKERS = scenario['workers']
+    forest_classification.HTTP_SESSION = forest_classification._build_http_session(scenario['workers'])
+    forest_classification.HTTP_SESSION.mount(fake_ee.TILE_URL, tiles)
+    forest_classification.PROTECTED_AREA_CACHE_DIR = os.path.join(workdir, 'protected-areas')
+
+    event = {'body': json.dumps({
+        'operation': scenario['operation'],
+        'filename': 'benchmark.json',
+        'start_date': '2024-06-01',
+        'end_date': '2024-06-30',
+        'output_mode': scenario.get('output_mode', 'image'),
+    })}
+    latencies, failures = [], 0
+    for _ in range(options['iterations']):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            response = lambda_function.lambda_handler(event, FakeLambdaContext())
+            latencies.append((time.perf_counter() - start) * 1000)
+        if response['statusCode'] != 200 or json.loads(response['body']).get('status') != 'success':
+            failures += 1
+            print(f"{scenario['name']}: status {response['statusCode']}: {response['body'][:500]}", file=sys.stderr)
+
+    latencies.sort()
+    s3_stats, tile_stats = s3.stats(), tiles.stats()
+    return {
+        'scenario': scenario,
+        'iterations': options['iterations'],
+        'failures': failures,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 1),
+            'p90': round(percentile(latencies, 0.90), 1),
+            'p99': round(percentile(latencies, 0.99), 1),
+            'mean': round(sum(latencies) / len(latencies), 1),
+            'min': round(latencies[0], 1),
+            'max': round(latencies[-1], 1),
+        },
+        'peak_rss_mb': peak_rss_mb(),
+        'tile_requests_per_iteration': round(tile_stats['requests'] / options['iterations'], 1),
+        'tile_errors': tile_stats['errors'],
+        'tile_throttled': tile_stats['throttled'],
+        'bytes_downloaded_per_iteration': round((tile_stats['bytes_sent'] + s3_stats['bytes_downloaded']) / options['iterations']),
+        'bytes_uploaded_per_iteration': round(s3_stats['bytes_uploaded'] / options['iterations']),
+    }
+
+# --- Baseline comparison ---
+def compare(results, baseline, tolerance):
+    """Return a message per scenario whose p50 latency or peak RSS grew by more than tolerance."""
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        for label, now, before in (
+            ('p50 latency', current['latency_ms']['p50'], previous['latency_ms']['p50']),
+            ('peak RSS', current['peak_rss_mb'], previous['peak_rss_mb']),
+        ):
+            if before and now > before * (1 + tolerance):
+                regressions.append(f"{name}: {label} {before} -> {now} (+{(now / before - 1) * 100:.0f}%)")
+        if current['failures'] > previous['failures']:
+            regressions.append(f"{name}: failures {previous['failures']} -> {current['failures']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='*', help='Scenario names to run (default: all)')
+    parser.add_argument('--iterations', type=int, default=5, help='Invocations per scenario')
+    parser.add_argument('--latency-ms', type=float, default=100, help='Mean fake Earth Engine tile latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of tile requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of tile requests answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After seconds sent with 429 responses')
+    parser.add_argument('--output', default=DEFAULT_RESULTS_PATH, help='Where to write the results JSON')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='Baseline JSON to save or compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Also write the results to --baseline')
+    parser.add_argument('--compare', action='store_true', help='Exit 1 if any scenario regressed against --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative growth before a regression is reported')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    options = {
+        'iterations': args.iterations, 'latency_ms': args.latency_ms, 'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate, 'retry_after': args.retry_after,
+    }
+
+    if args.child:
+        with tempfile.TemporaryDirectory(prefix='forest-benchmark-') as workdir:
+            result = run_scenario(json.loads(args.child), options, workdir)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    # Check the baseline up front, so a missing one neither wastes a run nor overwrites --output
+    baseline = None
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; create one with --save-baseline before using --compare", file=sys.stderr)
+            return 2
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    scenarios = default_scenarios()
+    if args.scenarios:
+        scenarios = [scenario for scenario in scenarios if scenario['name'] in args.scenarios]
+    results = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options,
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+            child_args = [a for a in sys.argv[1:] if a not in ('--save-baseline', '--compare')]
+            subprocess.run([sys.executable, os.path.abspath(__file__), *child_args, '--child', json.dumps(scenario),
+                            '--result-file', result_file.name], check=True)
+            result = json.load(result_file)
+        results['scenarios'][scenario['name']] = result
+        latency = result['latency_ms']
+        print(f"{scenario['name']:<32} p50 {latency['p50']:>9.1f} ms  p90 {latency['p90']:>9.1f} ms  "
+              f"rss {result['peak_rss_mb']:>7.1f} MB  tiles {result['tile_requests_per_iteration']:>6}  "
+              f"down {result['bytes_downloaded_per_iteration'] / 1e6:>7.2f} MB  failures {result['failures']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
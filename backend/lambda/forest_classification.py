@@ -0,0 +1,2221 @@
+"""
+Earth Engine classification pipeline behind the 'analysis', 'batch_analysis' and 'timeseries'
+operations. Imported lazily by lambda_function, whose S3 client, metrics and helpers it shares.
+"""
+import ee
+import json
+import datetime
+import requests
+import requests.adapters
+import random
+import email.utils
+import io
+import queue
+import re
+from PIL import Image, ImageDraw
+import os
+import time
+from functools import lru_cache
+from shapely import wkt
+from shapely.geometry import Polygon, MultiPolygon, box, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+import shapely
+import math
+import calendar
+import concurrent.futures
+import hashlib
+import itertools
+import threading
+import uuid
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from boto3.s3.transfer import TransferConfig
+
+from lambda_function import s3, S3_BUCKET, OUTPUT_PREFIX, DOWNLOAD_EXPIRATION, DEBUG, METRICS, generate_presigned_url
+
+# --- Environment Variables ---
+# These variables are fetched from the Lambda environment for configuration
+ASSETS_BUCKET = os.environ['ASSETS_BUCKET']  # Bucket for static assets like credentials
+EE_KEY_S3_KEY = os.environ['EE_KEY_S3_KEY']  # S3 key for Earth Engine credentials
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() == 'true'  # Serve repeat analyses from S3
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', '604800'))  # Seconds before a cached result expires
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))  # Size cap for cached results
+RESULT_CACHE_EVICT_INTERVAL = int(os.environ.get('RESULT_CACHE_EVICT_INTERVAL', '3600'))  # Seconds between eviction passes of one container
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', str(shutil.disk_usage('/tmp').total // 2)))  # Defaults to half of the ephemeral storage
+
+# --- Pipeline Constants ---
+PIPELINE_VERSION = '5'  # Bump whenever a change alters the images or statistics the pipeline produces
+EXPORT_SCALE = 20  # Scale in meters of one output canvas pixel, and so of the tiles downloaded from Earth Engine
+STATS_SCALE = 10  # Scale in meters for the area statistics reduction
+DEFAULT_POINT_BUFFER_M = 1000  # Radius analyzed around point features in batch analysis
+RESULT_CACHE_PREFIX = f"{OUTPUT_PREFIX}/cache"  # S3 prefix for content-addressed analysis results
+PROTECTED_AREA_CACHE_PREFIX = f"{OUTPUT_PREFIX}/protected-areas"  # S3 prefix for clipped WDPA geometries
+PROTECTED_AREA_CACHE_DIR = "/tmp/forest_classification/protected-areas"  # Local copy reused by warm containers
+PROTECTED_AREA_MAX_ERROR = STATS_SCALE / 2  # Meters of error allowed when clipping, dissolving and simplifying WDPA polygons
+PROTECTED_AREA_MAX_BYTES = 256 * 1024  # Larger geometries are not sent back to Earth Engine inline, where they ride on every tile request
+WDPA_CURRENT_ASSET = 'WCMC/WDPA/current/polygons'  # Latest WDPA release, used for months that were not published
+WDPA_CURRENT_TTL = 3600  # Seconds a warm container trusts the last-read release of WDPA_CURRENT_ASSET
+WDPA_NOT_FOUND_PATTERN = re.compile(r'not found|does not exist', re.IGNORECASE)  # EEException text of a missing asset
+BOUNDARY_MAX_ERROR = STATS_SCALE / 2  # Meters a boundary may move when simplified before it is sent to Earth Engine
+BOUNDARY_CACHE_SIZE = 32  # Prepared boundaries (see BoundaryGeometry) kept for warm invocations
+MAX_SCENE_CLOUD_COVER = 1  # Highest CLOUDY_PIXEL_PERCENTAGE of the best scene that is still classified
+
+# --- Time Series Settings ---
+TIMESERIES_INTERVALS = {'monthly': 1, 'quarterly': 3, 'yearly': 12}  # Window length in months for generated windows
+MAX_TIMESERIES_WINDOWS = 120  # Largest number of windows accepted in one request (10 years of months)
+TIMESERIES_CHUNK_SIZE = 12  # Windows reduced server-side per Earth Engine round-trip
+TIMESERIES_WORKERS = 4  # Chunks evaluated concurrently
+MAX_TIMESERIES_IMAGES = 12  # Largest number of windows that may request per-window images
+
+# --- Classification Palette ---
+# Index i is the display color of class value i; NODATA_CLASS marks pixels outside the boundary or without data
+CLASS_COLORS = [
+    (65, 155, 223), (57, 125, 73), (136, 176, 83), (122, 135, 198), (228, 150, 53),
+    (223, 195, 90), (196, 40, 27), (165, 155, 143), (179, 159, 225), (0, 0, 0), (0, 64, 0)
+]
+CLASS_LABELS = ['Water', 'Trees', 'Grass', 'Flooded Vegetation', 'Crops', 'Shrub & Scrub', 'Built', 'Bare', 'Snow & Ice', 'Cloud', 'Natural Forest']
+NODATA_CLASS = 255  # Drawn black, also used for legend text
+LEGEND_BACKGROUND = 254  # Drawn white, only used by the legend
+CLASS_PALETTE = [channel for color in CLASS_COLORS for channel in color] + [0, 0, 0] * (256 - len(CLASS_COLORS))  # Flat 256-entry 'P' mode palette
+CLASS_PALETTE[LEGEND_BACKGROUND * 3:LEGEND_BACKGROUND * 3 + 3] = [255, 255, 255]
+MAX_IMAGE_DIMENSION = 5000  # Largest side in pixels of the single-image output
+STRIP_HEIGHT = 1024  # Rows per PNG strip in the 'strips' and 'tiles' output modes
+PYRAMID_TILE_SIZE = 256  # Side in pixels of the Web Mercator XYZ tiles in the 'tiles' output mode
+EARTH_CIRCUMFERENCE = 40075016.686  # Meters at the equator, used to pick the pyramid's native zoom level
+PYRAMID_ENCODE_WORKERS = os.cpu_count() or 2  # Threads encoding the PNG tiles of one band; Pillow releases the GIL while encoding
+PYRAMID_QUEUE_DEPTH = 2  # Completed canvas strips waiting for the pyramid thread before pasting tiles blocks
+PYRAMID_COMPRESS_LEVEL = 1  # zlib level of the XYZ tiles; higher levels cost far more CPU than they save in bytes
+OUTPUT_MODES = ('image', 'strips', 'tiles')
+
+# --- Tiling Limits ---
+EE_MAX_REQUEST_BYTES = 32 * 1024 * 1024  # Earth Engine's cap on the uncompressed size of one download request
+EE_MAX_GRID_DIMENSION = 10000  # Earth Engine's cap on either side of one download request, in pixels
+TILE_BYTES_PER_PIXEL = 1  # Tiles are single-band uint8 class rasters
+MAX_TILE_PIXELS = min(int(os.environ.get('TILE_MAX_PIXELS', str(2048 * 2048))), EE_MAX_REQUEST_BYTES // TILE_BYTES_PER_PIXEL)
+MIN_TILE_SIDE = 256  # Windows are not split below this many pixels per side
+TILE_MIN_COVERAGE = 0.5  # Split request-sized windows the boundary covers less of than this
+
+# --- Tile Download Settings ---
+TILE_WORKERS = 10  # Concurrent tile downloads, and the size of the shared HTTP connection pool
+TILE_QUEUE_DEPTH = 2 * TILE_WORKERS  # Tiles submitted but not yet pasted; bounds the decoded tiles held in memory
+TILE_MAX_RETRIES = 5  # Attempts per tile before it is given up
+TILE_REQUEST_TIMEOUT = 120  # Upper bound in seconds on a single tile download
+RETRY_BASE_DELAY = 1.0  # Seconds; the backoff ceiling doubles with every attempt
+RETRY_MAX_DELAY = 30.0  # Seconds; cap on the backoff ceiling and on honored Retry-After values
+CANCEL_POLL_INTERVAL = 1.0  # Seconds between cancellation checks while tiles are downloading
+TILE_CACHE_DIR = "/tmp/forest_classification/tiles"  # Downloaded tile PNGs kept for warm invocations
+WORKSPACE_DIR = "/tmp/forest_classification/requests"  # Parent of the private working directory of each request
+
+# --- S3 Transfer Settings ---
+S3_UPLOAD_WORKERS = 10  # Concurrent output uploads, and concurrent parts of one multipart upload
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # Outputs larger than this are uploaded in parts
+S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024  # Size of each part of a multipart upload
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD, multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                                    max_concurrency=S3_UPLOAD_WORKERS)
+
+# --- Analysis Context ---
+class AnalysisContext:
+    """
+    Per-request state of one analysis: its private workspace, the uploaded user data, and the boundary
+    once loaded. It is passed explicitly through the pipeline instead of living in module globals, so
+    any number of analyses can run concurrently in one process.
+    """
+    def __init__(self, workspace):
+        self.workspace = workspace  # Directory for the strips and tiles this request spills to disk
+        self.user_data = None  # Parsed JSON uploaded by the user, read from S3 straight into memory
+        self.boundary = None  # BoundaryGeometry: the simplified boundary, its prepared forms and Earth Engine geometry
+        self.boundary_box = None  # Bounding box for the boundary
+        self.area_km2 = 0  # Total area from user data in square kilometers
+
+    def load_boundary(self):
+        """Load the boundary from the user data and prepare it, reusing the preparation of an identical boundary."""
+        polygon, self.boundary_box, self.area_km2 = load_boundary(self.user_data)
+        self.boundary = prepare_boundary(polygon)
+
+    def lat_long(self):
+        """Boundary center as '+LAT+LON' with two decimals, used to name output files."""
+        minx, miny, maxx, maxy = self.boundary_box.bounds
+        return f"{round((miny + maxy) / 2, 2):+.2f}{round((minx + maxx) / 2, 2):+.2f}"
+
+@contextmanager
+def analysis_context():
+    """Create an AnalysisContext with a fresh workspace under WORKSPACE_DIR, removed when the request ends."""
+    os.makedirs(WORKSPACE_DIR, exist_ok=True)
+    workspace = tempfile.mkdtemp(dir=WORKSPACE_DIR)
+    try:
+        yield AnalysisContext(workspace)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+# --- HTTP Connection Pool ---
+def _build_http_session(pool_size=TILE_WORKERS):
+    """Build a requests session whose connection pool is shared by all tile download threads."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+HTTP_SESSION = _build_http_session()  # Keeps TLS connections to Earth Engine alive across tiles and invocations
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (delta-seconds or HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, overridden by a server-provided Retry-After."""
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+# --- Earth Engine Session Management ---
+class EarthEngineSession:
+    """
+    Process-level Earth Engine session shared by every invocation a container serves.
+    Credentials are fetched from S3 once and kept in memory, the OAuth token is refreshed
+    lazily when it expires, and ee.Initialize only runs again after an authentication failure.
+    """
+    AUTH_ERROR_TYPES = ('RefreshError', 'DefaultCredentialsError')  # google.auth.exceptions raised while minting tokens
+    AUTH_ERROR_STATUSES = (401,)  # HTTP status of a rejected token on errors that carry a response
+    # Phrases Earth Engine puts in an EEException when the API rejects the caller's credentials
+    AUTH_ERROR_PATTERN = re.compile(
+        r'\b401\b[^a-z]*unauthorized|\bunauthenticated\b|\binvalid_grant\b'
+        r'|invalid authentication credentials|not signed up for earth engine',
+        re.IGNORECASE)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._initialized = False
+        self.cold_path_invocations = 0  # Invocations that had to fetch credentials and call ee.Initialize
+        self.warm_path_invocations = 0  # Invocations that reused the existing session
+        self.reinitializations = 0  # Re-initializations triggered by authentication failures
+
+    def _load_credentials(self):
+        """Fetch the service account key from S3 into memory and build EE credentials from it."""
+        key_data = s3.get_object(Bucket=ASSETS_BUCKET, Key=EE_KEY_S3_KEY)['Body'].read().decode('utf-8')
+        service_account = json.loads(key_data).get('client_email')
+        if not service_account:
+            raise ValueError("client_email not found in GEE credentials file")
+        return ee.ServiceAccountCredentials(service_account, key_data=key_data)
+
+    def prefetch_credentials(self):
+        """
+        Fetch the credentials ahead of ensure_initialized on a cold container, so the download can overlap
+        other request I/O. Failures are only logged; ensure_initialized fetches again and raises.
+        """
+        with self._lock:
+            if self._credentials is not None or self._initialized:
+                return
+            try:
+                self._credentials = self._load_credentials()
+            except Exception as e:
+                print(f"Error prefetching Earth Engine credentials: {e}")
+
+    def _refresh_if_expired(self):
+        """Refresh the OAuth token in place if it has expired since the last invocation."""
+        if self._credentials is None or not getattr(self._credentials, 'token', None):
+            return
+        if getattr(self._credentials, 'expired', False):
+            import google.auth.transport.requests
+            self._credentials.refresh(google.auth.transport.requests.Request())
+            print('Earth Engine access token refreshed')
+
+    def ensure_initialized(self):
+        """Initialize Earth Engine on the cold path; reuse the session on the warm path."""
+        with self._lock:
+            if self._initialized:
+                self._refresh_if_expired()
+                self.warm_path_invocations += 1
+                return
+            if self._credentials is None:
+                self._credentials = self._load_credentials()
+            ee.Initialize(self._credentials)
+            self._initialized = True
+            self.cold_path_invocations += 1
+            print('Earth Engine initialized successfully')
+
+    def invalidate(self):
+        """Drop the session and cached credentials so the next call re-reads the key and re-initializes."""
+        with self._lock:
+            self._credentials = None
+            self._initialized = False
+
+    def is_auth_error(self, error):
+        """
+        Return True if an exception is an Earth Engine authentication failure: a google.auth token error,
+        an HTTP 401 response, or an EEException carrying the API's UNAUTHENTICATED status. Errors
+        that merely mention a number such as 401 in an asset id are not authentication failures.
+        """
+        while error is not None:
+            if type(error).__name__ in self.AUTH_ERROR_TYPES:
+                return True
+            status = (getattr(getattr(error, 'resp', None), 'status', None)  # googleapiclient HttpError
+                      or getattr(getattr(error, 'response', None), 'status_code', None))  # requests HTTPError
+            if status in self.AUTH_ERROR_STATUSES:
+                return True
+            if isinstance(error, ee.EEException) and self.AUTH_ERROR_PATTERN.search(str(error)):
+                return True
+            error = error.__cause__
+        return False
+
+    def run(self, func, *args, **kwargs):
+        """Run an Earth Engine workload, re-initializing and retrying once on an authentication failure."""
+        with METRICS.span('ee_initialize'):
+            self.ensure_initialized()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not self.is_auth_error(e):
+                raise
+            print(f"Earth Engine authentication failed ({e}), re-initializing session")
+            self.invalidate()
+            self.ensure_initialized()
+            with self._lock:
+                self.reinitializations += 1
+            return func(*args, **kwargs)
+
+    def stats(self):
+        """Report how many invocations took the cold and warm initialization paths."""
+        return {
+            'cold_path_invocations': self.cold_path_invocations,
+            'warm_path_invocations': self.warm_path_invocations,
+            'reinitializations': self.reinitializations,
+        }
+
+EE_SESSION = EarthEngineSession()  # Reused across warm invocations of this container
+
+# --- Tile Cache ---
+class TileCache:
+    """
+    Least-recently-used cache of downloaded tile PNGs under TILE_CACHE_DIR, bounded by total bytes.
+    Files survive warm invocations of the container; the index is rebuilt from the directory on first
+    use, oldest modification time first, and a hit refreshes the file's modification time.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # OrderedDict of key -> bytes, least recently used first
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(composite_id, transform, window):
+        """Cache key of one tile: the composite it was cut from, its grid position and size, the scale and the pipeline version."""
+        payload = json.dumps({
+            'composite': composite_id,
+            'transform': [round(value, 12) for value in transform],
+            'dimensions': list(window[2:]),
+            'export_scale': EXPORT_SCALE,
+            'pipeline_version': PIPELINE_VERSION,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _load_index(self):
+        """Index the files left by earlier invocations. Called with the lock held."""
+        if self._entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        self._total_bytes = sum(self._entries.values())
+
+    def get(self, key):
+        """Return the cached PNG bytes for a key, or None on a miss."""
+        with self._lock:
+            self._load_index()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key))
+            return data
+        except OSError:
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key, data):
+        """Store PNG bytes under a key, then evict least recently used tiles until the cache fits."""
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._load_index()
+        temp_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))  # Readers never see a partially written tile
+        except OSError as e:
+            print(f"Error writing tile cache entry: {e}")
+            return
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total_bytes > self.max_bytes and self._entries:
+                evicted_key, evicted_bytes = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_bytes
+                self.evictions += 1
+                try:
+                    os.remove(self._path(evicted_key))
+                except OSError:
+                    pass
+
+    def stats(self):
+        """Report hit/miss/eviction counters and the current size of the cache."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries or {}),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+TILE_CACHE = TileCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES)  # Shared by all tile download threads and warm invocations
+
+# --- S3 Transfers ---
+@METRICS.timed('s3_download')
+def fetch_inputs(filename):
+    """
+    Read an uploaded JSON file from S3 straight into memory and parse it. On a cold container the
+    Earth Engine key is fetched at the same time, so neither download waits for the other.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(EE_SESSION.prefetch_credentials)
+        body = s3.get_object(Bucket=S3_BUCKET, Key=f"uploads/{filename}")['Body'].read()
+    return json.loads(body)
+
+def upload_bytes(s3_key, body, content_type):
+    """Upload an in-memory output; above S3_MULTIPART_THRESHOLD it is sent as concurrent multipart parts."""
+    if len(body) > S3_MULTIPART_THRESHOLD:
+        s3.upload_fileobj(io.BytesIO(body), S3_BUCKET, s3_key, ExtraArgs={'ContentType': content_type}, Config=S3_TRANSFER_CONFIG)
+    else:
+        s3.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=body, ContentType=content_type)
+
+def upload_json(s3_key, data):
+    """Upload a JSON document serialized in memory."""
+    upload_bytes(s3_key, json.dumps(data, indent=2).encode('utf-8'), 'application/json')
+
+def upload_file(path, s3_key, content_type):
+    """Upload a file spilled to the workspace, in concurrent parts if it is large."""
+    s3.upload_file(path, S3_BUCKET, s3_key, ExtraArgs={'ContentType': content_type}, Config=S3_TRANSFER_CONFIG)
+
+def wait_for_uploads(futures):
+    """Wait for every submitted upload and raise the first error, if any."""
+    for future in futures:
+        future.result()
+
+def run_analysis(request_body, progress_callback=None, deadline=None):
+    """
+    Run the full analysis for a request body and return (status_code, response_body).
+    Shared by the synchronous 'analysis' operation and background jobs.
+    progress_callback(stage, completed=None, total=None) is called as the pipeline advances, and
+    deadline (a time.monotonic() value) bounds how long tile downloads may keep retrying.
+    """
+    start_date = request_body.get('start_date')
+    end_date = request_body.get('end_date')
+    output_prefix = request_body.get('output_prefix', OUTPUT_PREFIX)
+    filename = request_body.get('filename')
+    output_mode = request_body.get('output_mode', 'image')
+    report_progress = progress_callback or (lambda stage, completed=None, total=None: None)
+
+    if not filename:
+        return 400, {
+            'status': 'error',
+            'message': 'Filename is required for analysis'
+        }
+    if output_mode not in OUTPUT_MODES:
+        return 400, {
+            'status': 'error',
+            'message': f"Unknown output_mode: {output_mode}. Valid modes are 'image', 'strips' or 'tiles'."
+        }
+
+    with analysis_context() as analysis:
+        # Read the user data from S3 into memory
+        analysis.user_data = fetch_inputs(filename)
+
+        # Serve repeat analyses of the same boundary and date window without touching Earth Engine
+        use_cache = RESULT_CACHE_ENABLED and output_mode == 'image' and not request_body.get('bypass_cache', False)
+        cache_key = result_cache_key(analysis.user_data, start_date, end_date)
+        with METRICS.span('result_cache_lookup'):
+            cached = get_cached_result(cache_key) if use_cache else None
+        if cached:
+            print(f"Result cache hit: {cache_key}")
+            return 200, {
+                'status': 'success',
+                'image_download_url': generate_presigned_url(
+                    'get_object',
+                    {
+                        'Bucket': S3_BUCKET,
+                        'Key': cached['image_key'],
+                        'ResponseContentType': 'image/png',
+                        'ResponseContentDisposition': f'attachment; filename="{cached["image_filename"]}"'
+                    },
+                    DOWNLOAD_EXPIRATION
+                ),
+                'image_date': cached['image_date'],
+                'analysis_results': cached['stats'],
+                'cache_hit': True
+            }
+
+        # Process the natural forest classification, reusing the container's Earth Engine session
+        report_progress('processing')
+        result = EE_SESSION.run(process_natural_forest_classification, analysis, start_date, end_date,
+                                progress_callback=progress_callback, output_mode=output_mode, deadline=deadline)
+        print(f"Earth Engine session: {EE_SESSION.stats()}")
+        if not result:
+            return 400, {
+                'status': 'error',
+                'message': 'Cloud cover is too much, please try another date range'
+            }
+
+        image_output, stats_data, image_date, errors = result
+        if not image_output and not stats_data:
+            raise RuntimeError('; '.join(f"{stage}: {message}" for stage, message in errors.items()))
+
+        # Generate unique file names using the boundary center
+        lat_long = analysis.lat_long()
+
+        # Upload results to S3 concurrently, presigning while the uploads are in flight
+        report_progress('uploading')
+        with METRICS.span('s3_upload'):
+            if output_mode == 'strips':
+                body = upload_strip_results(image_output, stats_data, output_prefix, f"{image_date}-{lat_long}", image_date)
+            elif output_mode == 'tiles':
+                body = upload_pyramid_results(image_output, stats_data, output_prefix, f"{image_date}-{lat_long}", image_date)
+            else:
+                image_download_url = None
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    uploads = []
+                    if image_output:
+                        s3_image_key = f"{output_prefix}/{image_date}-{lat_long}-natural_forest_classification.png"
+                        uploads.append(executor.submit(upload_bytes, s3_image_key, image_output, 'image/png'))
+
+                        # Generate a pre-signed URL for downloading the image
+                        image_download_url = generate_presigned_url(
+                            'get_object',
+                            {
+                                'Bucket': S3_BUCKET,
+                                'Key': s3_image_key,
+                                'ResponseContentType': 'image/png',
+                                'ResponseContentDisposition': f'attachment; filename="{image_date}-{lat_long}-natural_forest_classification.png"'
+                            },
+                            DOWNLOAD_EXPIRATION
+                        )
+
+                    if stats_data:
+                        s3_stats_key = f"{output_prefix}/{image_date}-{lat_long}-natural_forest_stats.json"
+                        uploads.append(executor.submit(upload_json, s3_stats_key, stats_data))
+                    wait_for_uploads(uploads)
+
+                body = {
+                    'status': 'success',
+                    'image_download_url': image_download_url,
+                    'image_date': image_date,
+                    'analysis_results': stats_data,
+                    'cache_hit': False,
+                    'ee_session': EE_SESSION.stats() if DEBUG else None
+                }
+
+        if DEBUG:
+            body['tile_cache'] = TILE_CACHE.stats()
+            body['timings'] = METRICS.summary()
+        if errors:
+            # One stage failed and the other was stopped; report whatever did complete
+            body['status'] = 'partial'
+            body['errors'] = errors
+        elif use_cache:
+            try:
+                store_cached_result(cache_key, s3_image_key, stats_data, image_date,
+                                    f"{image_date}-{lat_long}-natural_forest_classification.png")
+            except Exception as e:
+                print(f"Error storing result in cache: {e}")
+
+        return 200, body
+
+def run_batch_analysis(request_body):
+    """
+    Compute per-feature statistics for an uploaded GeoJSON FeatureCollection and return
+    (status_code, response_body). Only statistics are produced; no image is exported.
+    """
+    start_date = request_body.get('start_date')
+    end_date = request_body.get('end_date')
+    output_prefix = request_body.get('output_prefix', OUTPUT_PREFIX)
+    filename = request_body.get('filename')
+
+    if not filename:
+        return 400, {
+            'status': 'error',
+            'message': 'Filename is required for analysis'
+        }
+
+    with analysis_context() as analysis:
+        # Read the user data from S3 into memory
+        analysis.user_data = fetch_inputs(filename)
+
+        point_buffer_m = request_body.get('point_buffer_m', DEFAULT_POINT_BUFFER_M)
+        try:
+            point_buffer_m = float(point_buffer_m)
+        except (TypeError, ValueError):
+            return 400, {
+                'status': 'error',
+                'message': f"Invalid point_buffer_m: {point_buffer_m!r}, expected a number of meters"
+            }
+        try:
+            result = EE_SESSION.run(process_feature_batch, analysis, start_date, end_date, point_buffer_m)
+        except ValueError as e:
+            return 400, {
+                'status': 'error',
+                'message': str(e)
+            }
+        if not result:
+            return 400, {
+                'status': 'error',
+                'message': 'Cloud cover is too much, please try another date range'
+            }
+
+        feature_stats, image_date, union_polygon = result
+        minx, miny, maxx, maxy = union_polygon.bounds
+        lat_long = f"{round((miny + maxy) / 2, 2):+.2f}{round((minx + maxx) / 2, 2):+.2f}"
+        s3_stats_key = f"{output_prefix}/{image_date}-{lat_long}-natural_forest_batch_stats.json"
+        with METRICS.span('s3_upload'):
+            upload_json(s3_stats_key, feature_stats)
+
+    return 200, {
+        'status': 'success',
+        'image_date': image_date,
+        'feature_count': len(feature_stats),
+        'feature_results': feature_stats,
+        'stats_download_url': generate_presigned_url('get_object', {'Bucket': S3_BUCKET, 'Key': s3_stats_key}, DOWNLOAD_EXPIRATION),
+        'timings': METRICS.summary() if DEBUG else None
+    }
+
+def run_timeseries(request_body, deadline=None):
+    """
+    Compute land cover statistics for a list of date windows over one uploaded boundary and return
+    (status_code, response_body). Windows are given as 'windows' ([{'start_date', 'end_date'}, ...])
+    or generated from 'start_date'/'end_date' and an 'interval'. With 'include_images', each usable
+    window also gets a classification image.
+    """
+    output_prefix = request_body.get('output_prefix', OUTPUT_PREFIX)
+    filename = request_body.get('filename')
+    include_images = bool(request_body.get('include_images', False))
+
+    if not filename:
+        return 400, {
+            'status': 'error',
+            'message': 'Filename is required for analysis'
+        }
+    try:
+        windows = build_timeseries_windows(request_body)
+    except ValueError as e:
+        return 400, {
+            'status': 'error',
+            'message': str(e)
+        }
+    if include_images and len(windows) > MAX_TIMESERIES_IMAGES:
+        return 400, {
+            'status': 'error',
+            'message': f"Per-window images are limited to {MAX_TIMESERIES_IMAGES} windows, got {len(windows)}"
+        }
+
+    with analysis_context() as analysis:
+        # Read the user data from S3 into memory
+        analysis.user_data = fetch_inputs(filename)
+
+        rows, images = EE_SESSION.run(process_timeseries, analysis, windows, include_images=include_images, deadline=deadline)
+        print(f"Earth Engine session: {EE_SESSION.stats()}")
+
+        lat_long = analysis.lat_long()
+        name_prefix = f"{windows[0]['start_date']}_{windows[-1]['end_date']}-{lat_long}"
+        s3_stats_key = f"{output_prefix}/{name_prefix}-natural_forest_timeseries.json"
+        stats_body = json.dumps({'total_area_km2': analysis.area_km2, 'windows': rows}, indent=2).encode('utf-8')
+        with METRICS.span('s3_upload'), concurrent.futures.ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS) as executor:
+            # The stats and window images are uploaded concurrently, and presigned while the uploads are in flight
+            uploads = [executor.submit(upload_bytes, s3_stats_key, stats_body, 'application/json')]
+            for index, image_png in images.items():
+                image_name = f"{rows[index]['image_date']}-{lat_long}-natural_forest_classification.png"
+                s3_image_key = f"{output_prefix}/{name_prefix}-natural_forest_timeseries/{image_name}"
+                uploads.append(executor.submit(upload_bytes, s3_image_key, image_png, 'image/png'))
+                rows[index]['image_download_url'] = generate_presigned_url(
+                    'get_object',
+                    {
+                        'Bucket': S3_BUCKET,
+                        'Key': s3_image_key,
+                        'ResponseContentType': 'image/png',
+                        'ResponseContentDisposition': f'attachment; filename="{image_name}"'
+                    },
+                    DOWNLOAD_EXPIRATION
+                )
+            wait_for_uploads(uploads)
+
+        return 200, {
+            'status': 'success',
+            'window_count': len(rows),
+            'classified_count': sum(1 for row in rows if row['status'] == 'ok'),
+            'total_area_km2': round(analysis.area_km2, 5),
+            'windows': rows,
+            'stats_download_url': generate_presigned_url('get_object', {'Bucket': S3_BUCKET, 'Key': s3_stats_key}, DOWNLOAD_EXPIRATION),
+            'tile_cache': TILE_CACHE.stats() if DEBUG and include_images else None,
+            'timings': METRICS.summary() if DEBUG else None
+        }
+
+def build_timeseries_windows(request_body):
+    """
+    Return the time series windows of a request as [{'start_date', 'end_date'}, ...] in 'YYYY-MM-DD'.
+    End dates are exclusive, as in Earth Engine's filterDate. Raises ValueError on invalid input.
+    """
+    def parse_date(value, field):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {field}: {value!r}, expected YYYY-MM-DD")
+
+    if request_body.get('windows') is not None:
+        windows = request_body['windows']
+        if not isinstance(windows, list) or not all(isinstance(window, dict) for window in windows):
+            raise ValueError("windows must be a list of {'start_date', 'end_date'} objects")
+        dates = [(parse_date(window.get('start_date'), 'start_date'), parse_date(window.get('end_date'), 'end_date'))
+                 for window in windows]
+    else:
+        interval = request_body.get('interval', 'monthly')
+        if not isinstance(interval, str) or interval not in TIMESERIES_INTERVALS:
+            raise ValueError(f"Unknown interval: {interval}. Valid intervals are {', '.join(TIMESERIES_INTERVALS)}.")
+        start = parse_date(request_body.get('start_date'), 'start_date')
+        end = parse_date(request_body.get('end_date'), 'end_date')
+        dates, months = [], 0
+        while True:
+            window_start = add_months(start, months)
+            if window_start >= end or len(dates) > MAX_TIMESERIES_WINDOWS:
+                break
+            months += TIMESERIES_INTERVALS[interval]
+            dates.append((window_start, min(add_months(start, months), end)))
+
+    if not dates:
+        raise ValueError("At least one date window is required")
+    if len(dates) > MAX_TIMESERIES_WINDOWS:
+        raise ValueError(f"At most {MAX_TIMESERIES_WINDOWS} windows are allowed per request")
+    for window_start, window_end in dates:
+        if window_end <= window_start:
+            raise ValueError(f"Window end date {window_end} is not after its start date {window_start}")
+    return [{'start_date': window_start.isoformat(), 'end_date': window_end.isoformat()} for window_start, window_end in dates]
+
+def add_months(date, months):
+    """Shift a date by whole months, clamping the day to the length of the target month."""
+    month_index = date.month - 1 + months
+    year, month = date.year + month_index // 12, month_index % 12 + 1
+    return date.replace(year=year, month=month, day=min(date.day, calendar.monthrange(year, month)[1]))
+
+def upload_strip_results(manifest, stats_data, output_prefix, name_prefix, image_date):
+    """
+    Upload the strips, their manifest and the stats concurrently, and build the 'strips' mode response
+    body. Either input may be None when its pipeline stage did not complete.
+    """
+    strips_prefix = f"{output_prefix}/{name_prefix}-natural_forest_classification-strips"
+    manifest = manifest or {'strips': [], 'width': None, 'height': None}
+    output_dir = manifest.pop('directory', None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS) as executor:
+        uploads, image_strips = [], []
+        for strip in manifest['strips']:
+            s3_strip_key = f"{strips_prefix}/{strip['file']}"
+            uploads.append(executor.submit(upload_file, os.path.join(output_dir, strip['file']), s3_strip_key, 'image/png'))
+            image_strips.append({
+                'url': generate_presigned_url('get_object', {'Bucket': S3_BUCKET, 'Key': s3_strip_key, 'ResponseContentType': 'image/png'}, DOWNLOAD_EXPIRATION),
+                'row_offset': strip['row_offset'],
+                'rows': strip['rows'],
+            })
+        manifest_download_url = None
+        if output_dir:
+            s3_manifest_key = f"{strips_prefix}/manifest.json"
+            uploads.append(executor.submit(upload_json, s3_manifest_key, manifest))
+            manifest_download_url = generate_presigned_url('get_object', {'Bucket': S3_BUCKET, 'Key': s3_manifest_key}, DOWNLOAD_EXPIRATION)
+        if stats_data:
+            uploads.append(executor.submit(upload_json, f"{output_prefix}/{name_prefix}-natural_forest_stats.json", stats_data))
+        wait_for_uploads(uploads)
+    return {
+        'status': 'success',
+        'image_download_url': None,
+        'manifest_download_url': manifest_download_url,
+        'image_strips': image_strips,
+        'image_size': [manifest['width'], manifest['height']],
+        'image_date': image_date,
+        'analysis_results': stats_data,
+        'cache_hit': False
+    }
+
+def upload_pyramid_results(manifest, stats_data, output_prefix, name_prefix, image_date):
+    """
+    Upload the XYZ tiles and the stats concurrently, then a manifest of the tiles' pre-signed URLs,
+    and build the 'tiles' mode response body. Either input may be None when its stage did not complete.
+    """
+    tiles_prefix = f"{output_prefix}/{name_prefix}-natural_forest_classification-tiles"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS) as executor:
+        uploads = []
+        if stats_data:
+            uploads.append(executor.submit(upload_json, f"{output_prefix}/{name_prefix}-natural_forest_stats.json", stats_data))
+        manifest_download_url = None
+        if manifest:
+            tiles_dir = manifest.pop('directory')
+            tile_urls = {}
+            for tile in manifest['tiles']:
+                s3_tile_key = f"{tiles_prefix}/{tile}.png"
+                uploads.append(executor.submit(upload_file, os.path.join(tiles_dir, f"{tile}.png"), s3_tile_key, 'image/png'))
+                tile_urls[tile] = generate_presigned_url('get_object', {'Bucket': S3_BUCKET, 'Key': s3_tile_key}, DOWNLOAD_EXPIRATION)
+            manifest['tiles'] = tile_urls
+            s3_manifest_key = f"{tiles_prefix}/manifest.json"
+            uploads.append(executor.submit(upload_bytes, s3_manifest_key, json.dumps(manifest).encode('utf-8'), 'application/json'))
+            manifest_download_url = generate_presigned_url('get_object', {'Bucket': S3_BUCKET, 'Key': s3_manifest_key}, DOWNLOAD_EXPIRATION)
+        wait_for_uploads(uploads)
+    if manifest:
+        shutil.rmtree(tiles_dir, ignore_errors=True)
+    return {
+        'status': 'success',
+        'image_download_url': None,
+        'manifest_download_url': manifest_download_url,
+        'tile_count': len(manifest['tiles']) if manifest else 0,
+        'min_zoom': manifest['min_zoom'] if manifest else None,
+        'max_zoom': manifest['max_zoom'] if manifest else None,
+        'bounds': manifest['bounds'] if manifest else None,
+        'image_date': image_date,
+        'analysis_results': stats_data,
+        'cache_hit': False
+    }
+
+# --- Result Cache ---
+def result_cache_key(data, start_date, end_date):
+    """
+    Build a content-addressed cache key for an analysis request.
+    Hashes the normalized boundary geometry, the reported area, the bounding box (which sets the
+    canvas extent and the output file names), the date window, the output scales and the pipeline
+    version, so any change to what would be computed yields a new key.
+    """
+    geometry = wkt.loads(data['city_geometry']).normalize()
+    payload = json.dumps({
+        'geometry': wkt.dumps(geometry, rounding_precision=6),
+        'area': data.get('area', 0),
+        'bbox': [data['bbox_west'], data['bbox_south'], data['bbox_east'], data['bbox_north']],
+        'start_date': str(start_date).strip(),
+        'end_date': str(end_date).strip(),
+        'export_scale': EXPORT_SCALE,
+        'stats_scale': STATS_SCALE,
+        'pipeline_version': PIPELINE_VERSION,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_cached_result(cache_key):
+    """Return the cache entry for a key, or None if it is missing or older than RESULT_CACHE_TTL."""
+    try:
+        entry = json.loads(s3.get_object(Bucket=S3_BUCKET, Key=f"{RESULT_CACHE_PREFIX}/{cache_key}/entry.json")['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"Error reading result cache entry: {e}")
+        return None
+    if time.time() - entry.get('created_at', 0) > RESULT_CACHE_TTL:
+        print(f"Result cache entry expired: {cache_key}")
+        delete_cached_result(cache_key)
+        return None
+    return entry
+
+def store_cached_result(cache_key, s3_image_key, stats_data, image_date, image_filename):
+    """Copy the final image under the cache prefix, write its index entry, and enforce the size cap when due."""
+    cached_image_key = f"{RESULT_CACHE_PREFIX}/{cache_key}/image.png"
+    s3.copy_object(Bucket=S3_BUCKET, Key=cached_image_key, CopySource={'Bucket': S3_BUCKET, 'Key': s3_image_key},
+                   ContentType='image/png', MetadataDirective='REPLACE')
+    entry = {
+        'image_key': cached_image_key,
+        'image_filename': image_filename,
+        'image_date': image_date,
+        'stats': stats_data,
+        'created_at': time.time(),
+        'pipeline_version': PIPELINE_VERSION,
+    }
+    s3.put_object(Bucket=S3_BUCKET, Key=f"{RESULT_CACHE_PREFIX}/{cache_key}/entry.json",
+                  Body=json.dumps(entry).encode('utf-8'), ContentType='application/json')
+    if result_cache_eviction_due():
+        evict_result_cache()
+
+def delete_cached_result(cache_key):
+    """Remove every object stored for a cache key."""
+    prefix = f"{RESULT_CACHE_PREFIX}/{cache_key}/"
+    objects = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix).get('Contents', [])
+    if objects:
+        s3.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': [{'Key': obj['Key']} for obj in objects]})
+
+_RESULT_CACHE_EVICTED_AT = None  # time.monotonic() of this container's last eviction pass
+_RESULT_CACHE_EVICTION_LOCK = threading.Lock()
+
+def result_cache_eviction_due():
+    """
+    Claim an eviction pass if this container has not run one in the last RESULT_CACHE_EVICT_INTERVAL.
+    Eviction lists the whole cache prefix, so most stores skip it; the cap may be exceeded in between.
+    """
+    global _RESULT_CACHE_EVICTED_AT
+    with _RESULT_CACHE_EVICTION_LOCK:
+        now = time.monotonic()
+        if _RESULT_CACHE_EVICTED_AT is not None and now - _RESULT_CACHE_EVICTED_AT < RESULT_CACHE_EVICT_INTERVAL:
+            return False
+        _RESULT_CACHE_EVICTED_AT = now
+        return True
+
+def evict_result_cache():
+    """Delete expired cache entries, then the oldest ones until the cache fits in RESULT_CACHE_MAX_BYTES."""
+    entries = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{RESULT_CACHE_PREFIX}/"):
+        for obj in page.get('Contents', []):
+            cache_key = obj['Key'][len(RESULT_CACHE_PREFIX) + 1:].split('/', 1)[0]
+            entry = entries.setdefault(cache_key, {'bytes': 0, 'modified': obj['LastModified'].timestamp()})
+            entry['bytes'] += obj['Size']
+            entry['modified'] = max(entry['modified'], obj['LastModified'].timestamp())
+
+    now, total_bytes = time.time(), sum(e['bytes'] for e in entries.values())
+    for cache_key, entry in sorted(entries.items(), key=lambda item: item[1]['modified']):
+        if now - entry['modified'] <= RESULT_CACHE_TTL and total_bytes <= RESULT_CACHE_MAX_BYTES:
+            continue
+        print(f"Evicting result cache entry {cache_key} ({entry['bytes']} bytes)")
+        delete_cached_result(cache_key)
+        total_bytes -= entry['bytes']
+
+# --- Earth Engine Processing ---
+def process_natural_forest_classification(analysis, start_date, end_date, progress_callback=None, output_mode='image', deadline=None):
+    """
+    Process natural forest classification using Earth Engine data.
+    Combines Sentinel-2 and Dynamic World data to classify forests and calculate statistics.
+    Loads the boundary of the AnalysisContext and writes every output into its workspace.
+    """
+    start_time = time.time()
+    analysis.load_boundary()
+
+    classification = build_classification(analysis.boundary, start_date, end_date)
+    if not classification:
+        return None
+    enhanced_classification, image_date, wdpa_release = classification
+    composite_id = composite_identity(analysis.boundary, start_date, end_date, image_date, wdpa_release)
+
+    # Statistics and image export are independent and both mostly wait on Earth Engine, so run them
+    # side by side. If one fails the other is cancelled and whatever completed is still returned.
+    print("Calculating area statistics and processing image concurrently...")
+    if progress_callback:
+        progress_callback('statistics')
+    cancel_event = threading.Event()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    image_future = executor.submit(process_and_export_image, enhanced_classification, image_date, analysis, progress_callback,
+                                   output_mode, deadline, cancel_event, composite_id)
+    stages = {
+        executor.submit(calculate_area_statistics, enhanced_classification, analysis.boundary.ee_geometry, analysis.area_km2,
+                        image_date): 'statistics',
+        image_future: 'image',
+    }
+    outputs, errors = {}, {}
+    try:
+        pending = set(stages)
+        while pending and not errors:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in done:
+                try:
+                    outputs[stages[future]] = future.result()
+                except Exception as e:
+                    print(f"Error in {stages[future]} stage: {e}")
+                    errors[stages[future]] = str(e)
+                    cancel_event.set()
+    finally:
+        # Do not wait for the statistics stage once it is discarded, but do wait for a cancelled image
+        # stage: it writes into the workspace, which is removed when the request ends. It stops
+        # within CANCEL_POLL_INTERVAL of cancel_event being set.
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        concurrent.futures.wait([image_future])
+
+    stats_data = outputs.get('statistics')
+    image_output = outputs.get('image')
+    if not errors and not image_output:
+        errors['image'] = 'No sub-rectangle image could be downloaded'
+    
+    print(f"Total execution time: {time.time() - start_time:.2f} seconds")
+    return image_output, stats_data, image_date, errors
+
+def process_feature_batch(analysis, start_date, end_date, point_buffer_m=DEFAULT_POINT_BUFFER_M):
+    """
+    Classify the union of every feature in a FeatureCollection once, then compute all per-feature
+    class histograms with a single reduceRegions call over that shared classification image.
+    Returns (feature_stats, image_date, union_polygon), or None if no usable scene exists.
+    """
+    start_time = time.time()
+    features = load_feature_collection(analysis.user_data, point_buffer_m)
+    union_polygon = unary_union([feature['geometry'] for feature in features])
+    print(f"Loaded {len(features)} features for batch analysis")
+
+    classification = build_classification(prepare_boundary(union_polygon), start_date, end_date)
+    if not classification:
+        return None
+    enhanced_classification, image_date, _ = classification
+
+    print("Calculating per-feature area statistics...")
+    feature_stats = calculate_feature_statistics(enhanced_classification, features, image_date)
+
+    print(f"Total execution time: {time.time() - start_time:.2f} seconds")
+    return feature_stats, image_date, union_polygon
+
+def process_timeseries(analysis, windows, include_images=False, deadline=None):
+    """
+    Classify one boundary over many date windows. The boundary, its Earth Engine geometry and the
+    protected-area mask are prepared once; scene selection and the class histogram of every window
+    are then evaluated server-side by mapping over an ee.List of windows, so a whole chunk of
+    TIMESERIES_CHUNK_SIZE windows costs one round-trip. The protected-area mask is taken from the
+    WDPA release of the last window, so changes between windows reflect land cover only.
+    Returns (rows, images), with images mapping window index to the window's PNG bytes.
+    """
+    start_time = time.time()
+    analysis.load_boundary()
+    protected_areas, wdpa_release = get_protected_areas(analysis.boundary, windows[-1]['start_date'])
+
+    def summarize_window(window):
+        window = ee.Dictionary(window)
+        s2, dw_collection = scene_collections(window.get('start_date'), window.get('end_date'), analysis.boundary.ee_geometry)
+        # ee.Algorithms.If is evaluated lazily, so unusable windows never touch first() or the reduction
+        has_images = s2.size().gt(0)
+        cloud_cover = ee.Algorithms.If(has_images, ee.Image(s2.first()).get('CLOUDY_PIXEL_PERCENTAGE'), None)
+        usable = ee.Algorithms.If(has_images, ee.Number(cloud_cover).lte(MAX_SCENE_CLOUD_COVER).And(dw_collection.size().gt(0)), False)
+        return ee.Dictionary({
+            's2_count': s2.size(),
+            'cloud_cover': cloud_cover,
+            'image_date': ee.Algorithms.If(has_images, ee.Date(ee.Image(s2.first()).get('system:time_start')).format('YYYY-MM-dd'), None),
+            'dw_count': dw_collection.size(),
+            'histogram': ee.Algorithms.If(usable, class_histogram(classify_land_cover(dw_collection, protected_areas), analysis.boundary.ee_geometry), None),
+        })
+
+    def reduce_chunk(chunk):
+        with METRICS.span('timeseries_reduction'):
+            return ee.List(chunk).map(summarize_window).getInfo()
+
+    chunks = [windows[i:i + TIMESERIES_CHUNK_SIZE] for i in range(0, len(windows), TIMESERIES_CHUNK_SIZE)]
+    print(f"Reducing {len(windows)} windows in {len(chunks)} Earth Engine requests...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(TIMESERIES_WORKERS, len(chunks))) as executor:
+        summaries = [summary for chunk_summaries in executor.map(reduce_chunk, chunks) for summary in chunk_summaries]
+
+    rows = [timeseries_row(window, summary, analysis.area_km2) for window, summary in zip(windows, summaries)]
+
+    images = {}
+    if include_images:
+        for index, row in enumerate(rows):
+            if row['status'] != 'ok':
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                print("Deadline reached, skipping the remaining window images")
+                break
+            print(f"Exporting image for window {row['start_date']} to {row['end_date']}...")
+            _, dw_collection = scene_collections(row['start_date'], row['end_date'], analysis.boundary.ee_geometry)
+            composite_id = composite_identity(analysis.boundary, row['start_date'], row['end_date'], row['image_date'], wdpa_release)
+            image_png = process_and_export_image(classify_land_cover(dw_collection, protected_areas), row['image_date'], analysis,
+                                                 deadline=deadline, composite_id=composite_id)
+            if image_png:
+                images[index] = image_png
+
+    print(f"Total execution time: {time.time() - start_time:.2f} seconds")
+    return rows, images
+
+def timeseries_row(window, summary, total_area):
+    """Flatten one window's server-side summary into a compact row of the time series table."""
+    if summary['s2_count'] == 0:
+        status = 'no_images'
+    elif summary['cloud_cover'] > MAX_SCENE_CLOUD_COVER:
+        status = 'cloudy'
+    elif summary['dw_count'] == 0:
+        status = 'no_dynamic_world'
+    else:
+        status = 'ok'
+    row = {
+        'start_date': window['start_date'],
+        'end_date': window['end_date'],
+        'status': status,
+        'image_date': summary['image_date'],
+        'cloud_cover': summary['cloud_cover'],
+    }
+    if status == 'ok':
+        stats = build_area_statistics(summary['histogram'] or {}, total_area, summary['image_date'])
+        row.update({
+            'forest_area_km2': stats['forest_area_km2'],
+            'natural_forest_km2': stats['natural_forest_km2'],
+            'natural_forest_percentage': stats['natural_forest_percentage'],
+            'other_trees_km2': stats['other_trees_km2'],
+            'land_cover_km2': {name: values['area_km2'] for name, values in stats['land_cover_classes'].items()},
+        })
+    return row
+
+def build_classification(boundary, start_date, end_date):
+    """
+    Select the scene for a BoundaryGeometry and build the enhanced classification image.
+    Returns (enhanced_classification, image_date, wdpa_release), where wdpa_release identifies the
+    protected-area mask (see resolve_wdpa_asset), or None if no usable scene exists.
+    """
+    # Fetch all scene metadata for the go/no-go decision in one round-trip
+    scene, dw_collection = select_scene(start_date, end_date, boundary.ee_geometry)
+    if scene['s2_count'] == 0:
+        print("No Sentinel-2 images found in the date range.")
+        return None
+    
+    cloud_cover = scene['cloud_cover']
+    print(f"Lowest cloud cover percentage: {cloud_cover}%")
+    if cloud_cover > MAX_SCENE_CLOUD_COVER:
+        print("Cloud cover is too much, please try another range")
+        return None
+    
+    image_date = scene['image_date']
+    if scene['dw_count'] == 0:
+        print("No Dynamic World images found for the given date range and boundary.")
+        return None
+    
+    protected_areas, wdpa_release = get_protected_areas(boundary, image_date)
+    return classify_land_cover(dw_collection, protected_areas), image_date, wdpa_release
+
+def composite_identity(boundary, start_date, end_date, image_date, wdpa_release):
+    """
+    Identify the classification image built for a boundary and date window. The Dynamic World
+    composite depends on the window and on the boundary used to filter scenes, and the protected-area
+    mask on the boundary and wdpa_release, the WDPA release get_protected_areas actually built it
+    from, so equal identities always produce identical tiles.
+    Returns None, which disables the tile cache, when the WDPA release is unknown.
+    """
+    if wdpa_release is None:
+        return None
+    payload = json.dumps({
+        'geometry': boundary.key,
+        'start_date': str(start_date).strip(),
+        'end_date': str(end_date).strip(),
+        'image_date': image_date,
+        'wdpa_release': wdpa_release,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def classify_land_cover(dw_collection, protected_areas):
+    """Build the classification image: the Dynamic World mode label, with trees in protected areas as class 10."""
+    dw_image = dw_collection.select('label').mode()
+
+    # Classify natural forests (trees in protected areas)
+    tree_mask = dw_image.eq(1)
+    natural_forest = tree_mask.And(protected_areas)
+    return dw_image.rename('classification').where(natural_forest, 10)
+
+def scene_collections(start_date, end_date, boundary):
+    """
+    Return the Sentinel-2 collection (low cloud cover, sorted best first) and the Dynamic World
+    collection for a date window. Dates may be strings or server-side values.
+    """
+    # Filter Sentinel-2 imagery for low cloud cover
+    s2 = (ee.ImageCollection('COPERNICUS/S2_HARMONIZED')
+          .filterDate(start_date, end_date)
+          .filterBounds(boundary)
+          .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 35))
+          .sort('CLOUDY_PIXEL_PERCENTAGE'))
+
+    # Get Dynamic World land cover data
+    dw_collection = (ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1')
+                     .filterDate(start_date, end_date)
+                     .filterBounds(boundary))
+    return s2, dw_collection
+
+@METRICS.timed('scene_selection')
+def select_scene(start_date, end_date, boundary):
+    """
+    Evaluate the scene selection metadata with a single server-side ee.Dictionary.
+    Returns the metadata (Sentinel-2 count, lowest cloud cover, its date, Dynamic World count)
+    together with the Dynamic World collection used for the classification.
+    """
+    s2, dw_collection = scene_collections(start_date, end_date, boundary)
+
+    # ee.Algorithms.If is evaluated lazily, so an empty collection never touches first()
+    has_images = s2.size().gt(0)
+    first_image = ee.Image(s2.first())
+    scene = ee.Dictionary({
+        's2_count': s2.size(),
+        'cloud_cover': ee.Algorithms.If(has_images, first_image.get('CLOUDY_PIXEL_PERCENTAGE'), None),
+        'image_date': ee.Algorithms.If(has_images, ee.Date(first_image.get('system:time_start')).format('YYYY-MM-dd'), None),
+        'dw_count': dw_collection.size(),
+    }).getInfo()
+    return scene, dw_collection
+
+# --- Boundary and Image Processing ---
+def split_boundary_box(boundary, boundary_box, width_pixels, height_pixels, max_tile_pixels=MAX_TILE_PIXELS):
+    """
+    Split the output canvas into pixel-aligned tiles with an adaptive quadtree.
+    A window is subdivided while it exceeds the per-request pixel/dimension limits, or while the
+    BoundaryGeometry covers less than TILE_MIN_COVERAGE of it, so sparse or irregular boundaries get
+    a few well-filled tiles and windows outside the polygon are never requested. Tile edges fall on
+    canvas pixel boundaries. Returns dicts holding the pixel 'window' (x, y, width, height), the
+    matching geographic 'shapely_sub_rect', and the 'mask_rings' of the boundary pre-clipped to the
+    tile (see tile_mask_rings).
+    """
+    minx, miny, maxx, maxy = boundary_box.bounds
+    pixel_x, pixel_y = (maxx - minx) / width_pixels, (maxy - miny) / height_pixels
+    tiles = []
+
+    def add_tile(x, y, width, height, sub_rect):
+        mask_rings = tile_mask_rings(boundary, boundary_box.bounds, width_pixels, height_pixels, (x, y, width, height))
+        tiles.append({'window': (x, y, width, height), 'shapely_sub_rect': sub_rect, 'mask_rings': mask_rings})
+
+    def subdivide(x, y, width, height):
+        sub_rect = box(minx + x * pixel_x, maxy - (y + height) * pixel_y, minx + (x + width) * pixel_x, maxy - y * pixel_y)
+        if not boundary.prepared.intersects(sub_rect):
+            return
+        fits_request = width * height <= max_tile_pixels and max(width, height) <= EE_MAX_GRID_DIMENSION
+        can_split_x, can_split_y = width >= 2 * MIN_TILE_SIDE, height >= 2 * MIN_TILE_SIDE
+        if fits_request and (
+            not (can_split_x or can_split_y)
+            or boundary.prepared.contains(sub_rect)
+            or boundary.polygon.intersection(sub_rect).area / sub_rect.area >= TILE_MIN_COVERAGE
+        ):
+            add_tile(x, y, width, height, sub_rect)
+            return
+        if not (can_split_x or can_split_y):
+            # Only reachable if max_tile_pixels is below MIN_TILE_SIDE squared; keep the tile anyway
+            add_tile(x, y, width, height, sub_rect)
+            return
+        half_width = width // 2 if can_split_x or width > EE_MAX_GRID_DIMENSION else width
+        half_height = height // 2 if can_split_y or height > EE_MAX_GRID_DIMENSION else height
+        for sub_x, sub_width in ((x, half_width), (x + half_width, width - half_width)):
+            for sub_y, sub_height in ((y, half_height), (y + half_height, height - half_height)):
+                if sub_width > 0 and sub_height > 0:
+                    subdivide(sub_x, sub_y, sub_width, sub_height)
+
+    subdivide(0, 0, width_pixels, height_pixels)
+    print(f"Adaptive tiling produced {len(tiles)} tiles for a {width_pixels}x{height_pixels} canvas")
+    return tiles
+
+def tile_mask_rings(boundary, bounds, width_pixels, height_pixels, window):
+    """
+    Pixel rings of the boundary mask clipped to one tile window, in the tile's own pixel coordinates,
+    or None if the tile lies entirely inside the boundary and needs no mask. The boundary is clipped
+    with a one-pixel margin, so the clip edges fall outside the tile and every pixel inside it is
+    drawn from the boundary's own edges, exactly as on the full canvas.
+    """
+    minx, miny, maxx, maxy = bounds
+    pixel_x, pixel_y = (maxx - minx) / width_pixels, (maxy - miny) / height_pixels
+    x, y, width, height = window
+    margin_rect = box(minx + (x - 1) * pixel_x, maxy - (y + height + 1) * pixel_y,
+                      minx + (x + width + 1) * pixel_x, maxy - (y - 1) * pixel_y)
+    if boundary.prepared_shell.contains(margin_rect):
+        return None
+    return boundary_pixel_rings(boundary.shell.intersection(margin_rect), bounds, width_pixels, height_pixels,
+                                col_offset=x, row_offset=y)
+
+def canvas_transform(bounds, width_pixels, height_pixels):
+    """Affine transform [xScale, 0, xOrigin, 0, -yScale, yOrigin] of the output canvas in EPSG:4326."""
+    minx, miny, maxx, maxy = bounds
+    return [(maxx - minx) / width_pixels, 0, minx, 0, -(maxy - miny) / height_pixels, maxy]
+
+def tile_transform(transform, window):
+    """Shift the canvas transform so its origin is the top-left pixel of a tile window."""
+    x_scale, _, x_origin, _, y_scale, y_origin = transform
+    x, y, _, _ = window
+    return [x_scale, 0, x_origin + x * x_scale, 0, y_scale, y_origin + y * y_scale]
+
+def export_sub_polygon_as_png(image, window, transform, deadline=None, max_retries=TILE_MAX_RETRIES, cancel_event=None):
+    """
+    Export a tile window from Earth Engine as a single-band uint8 class raster.
+    The tile is requested on the canvas pixel grid (crs_transform plus exact dimensions), so it
+    can be pasted without resampling. Returns the PNG bytes, whose pixel values are the class
+    values (see class_raster_from_png), or None if the tile could not be downloaded.
+    Downloads share HTTP_SESSION's connection pool. Throttling (429), server errors and network
+    failures are retried with jittered exponential backoff, honoring Retry-After, and no attempt
+    or wait is started that would run past the monotonic deadline.
+    """
+    class_image = image.unmask(NODATA_CLASS).toUint8()
+    _, _, width, height = window
+    params = {
+        'crs': 'EPSG:4326',
+        'crs_transform': tile_transform(transform, window),
+        'dimensions': f"{width}x{height}",
+        'format': 'png',
+    }
+
+    for retry in range(max_retries):
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        retry_after = None
+        try:
+            url = class_image.getDownloadURL(params)
+            timeout = TILE_REQUEST_TIMEOUT if deadline is None else min(TILE_REQUEST_TIMEOUT, deadline - time.monotonic())
+            if timeout <= 0:
+                print("Deadline reached before sub-rectangle download could start")
+                return None
+            response = HTTP_SESSION.get(url, timeout=timeout)
+            if response.status_code == 200:
+                METRICS.add('tile_bytes', len(response.content), 'Bytes')
+                return response.content
+            if response.status_code != 429 and response.status_code < 500:
+                print(f"Failed to download sub-rectangle image: {response.status_code}, not retrying")
+                return None
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            print(f"Failed to download sub-rectangle image: {response.status_code}, retry {retry+1}/{max_retries}")
+        except Exception as e:
+            print(f"Error downloading image: {e}, retry {retry+1}/{max_retries}")
+        if retry + 1 == max_retries:
+            break
+        METRICS.add('tile_retries', 1)
+        delay = backoff_delay(retry, retry_after)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            print("Deadline reached, giving up on sub-rectangle")
+            return None
+        if cancel_event is not None:
+            cancel_event.wait(delay)  # Wakes early if the export is cancelled
+        else:
+            time.sleep(delay)
+    return None
+
+def class_raster_from_png(png_bytes):
+    """Decode a single-band class PNG into a 'P' mode image carrying the classification palette."""
+    class_img = Image.open(io.BytesIO(png_bytes))
+    if class_img.mode != 'L':
+        class_img = class_img.convert('L')
+    class_img.putpalette(CLASS_PALETTE)  # Converts 'L' to 'P' in place without touching pixel values
+    return class_img
+
+def process_sub_polygon(args):
+    """
+    Process a single tile and export it as a class raster aligned to the canvas grid, masked outside
+    the boundary with the tile's pre-clipped mask rings.
+    Tiles of an identified composite are served from TILE_CACHE when possible, and cached after download.
+    """
+    index, tile, enhanced_classification, image_date, transform, deadline, cancel_event, composite_id = args
+    _, _, width, height = tile['window']
+    cache_key = TileCache.key(composite_id, tile_transform(transform, tile['window']), tile['window']) if composite_id else None
+    png_bytes = TILE_CACHE.get(cache_key) if cache_key else None
+    if png_bytes is None:
+        with METRICS.span('tile_download'):
+            png_bytes = export_sub_polygon_as_png(enhanced_classification, tile['window'], transform, deadline, cancel_event=cancel_event)
+        if png_bytes is None:
+            METRICS.add('tiles_failed', 1)
+            return None
+        if cache_key:
+            TILE_CACHE.put(cache_key, png_bytes)
+    class_img = _fit_tile(class_raster_from_png(png_bytes), width, height)
+    if tile['mask_rings'] is not None:
+        mask_outside_rings(class_img, tile['mask_rings'])
+    return {'index': index, 'image_date': image_date, 'png_image': class_img,
+            'shapely_sub_rect': tile['shapely_sub_rect'], 'window': tile['window']}
+
+def boundary_pixel_rings(shapely_polygon, bounds, width_pixels, height_pixels, col_offset=0, row_offset=0):
+    """
+    Exterior rings of a boundary in canvas pixel coordinates, shifted by col_offset/row_offset onto
+    a tile of the canvas. Interior rings are not masked, so holes in the boundary keep their pixels.
+    """
+    minx, miny, maxx, maxy = bounds
+    def geo_to_pixel(lon, lat):
+        x = int((lon - minx) / (maxx - minx) * width_pixels)
+        y = int((maxy - lat) / (maxy - miny) * height_pixels)
+        return max(0, min(x, width_pixels - 1)) - col_offset, max(0, min(y, height_pixels - 1)) - row_offset
+
+    parts = shapely_polygon.geoms if hasattr(shapely_polygon, 'geoms') else [shapely_polygon]
+    return [[geo_to_pixel(lon, lat) for lon, lat in part.exterior.coords] for part in parts if isinstance(part, Polygon)]
+
+def mask_outside_rings(class_img, rings):
+    """Set every pixel outside the given pixel rings to NODATA_CLASS, in place."""
+    inside = Image.new('L', class_img.size, 0)
+    draw = ImageDraw.Draw(inside)
+    for ring in rings:
+        draw.polygon(ring, fill=255)
+    class_img.paste(NODATA_CLASS, (0, 0) + class_img.size, inside.point(lambda v: 255 - v))
+
+def compute_canvas_size(bounds, max_dimension=MAX_IMAGE_DIMENSION):
+    """Size the output canvas for a bounding box, capped at max_dimension pixels unless it is None."""
+    minx, miny, maxx, maxy = bounds
+    lat_mid = (miny + maxy) / 2
+    meters_per_deg_lon, meters_per_deg_lat = 111000 * math.cos(math.radians(lat_mid)), 111000
+    width_m, height_m = (maxx - minx) * meters_per_deg_lon, (maxy - miny) * meters_per_deg_lat
+    width_pixels, height_pixels = [int(dim / EXPORT_SCALE) for dim in (width_m, height_m)]
+    
+    if max_dimension and (width_pixels > max_dimension or height_pixels > max_dimension):
+        scale_factor = max(width_pixels / max_dimension, height_pixels / max_dimension)
+        width_pixels, height_pixels = int(width_pixels / scale_factor), int(height_pixels / scale_factor)
+    return max(1, width_pixels), max(1, height_pixels)
+
+def _fit_tile(sub_img, width, height):
+    """
+    Return a tile sized to its canvas window. Tiles are requested on the canvas grid, so this
+    only resamples (nearest neighbour, since classes are categorical) if EE returned another size.
+    """
+    if sub_img.size == (width, height):
+        return sub_img
+    print(f"Tile size {sub_img.size} does not match its window {(width, height)}, resampling")
+    return sub_img.resize((width, height), Image.Resampling.NEAREST)
+
+class MosaicCanvas:
+    """
+    Streaming mosaic: the 'P' mode output canvas is allocated up front and each tile is pasted
+    as soon as its download completes, then released, so peak memory stays close to one canvas
+    plus the tiles still in flight.
+    """
+    def __init__(self, bounds, width_pixels, height_pixels):
+        self.bounds = bounds
+        self.width, self.height = width_pixels, height_pixels
+        self.image = Image.new('P', (width_pixels, height_pixels), NODATA_CLASS)
+        self.image.putpalette(CLASS_PALETTE)
+        self.tiles_pasted = 0
+
+    def add(self, result):
+        """Paste a finished tile into the canvas and free its image."""
+        sub_img = result.pop('png_image')
+        x, y, width, height = result['window']
+        if width > 0 and height > 0:
+            self.image.paste(_fit_tile(sub_img, width, height), (x, y))
+            self.tiles_pasted += 1
+        sub_img.close()
+
+    def skip(self, index):
+        """Record a tile that failed; the canvas keeps NODATA_CLASS in its window."""
+
+    def close(self):
+        """Free the canvas once the output has been encoded or the export abandoned."""
+        self.image.close()
+
+class StripMosaic:
+    """
+    Streaming mosaic written as horizontal PNG strips of at most strip_height rows, for mosaics
+    larger than MAX_IMAGE_DIMENSION. A strip is only held in memory until every tile overlapping
+    it has been pasted or has failed, then it is written to disk and freed.
+    """
+    def __init__(self, bounds, width_pixels, height_pixels, tiles, output_dir, file_prefix, strip_height=STRIP_HEIGHT):
+        self.bounds = bounds
+        self.width, self.height = width_pixels, height_pixels
+        self.output_dir, self.file_prefix = output_dir, file_prefix
+        self.strip_height = strip_height
+        self.num_strips = math.ceil(height_pixels / strip_height)
+        self.windows = [tile['window'] for tile in tiles]
+        self.pending = [0] * self.num_strips
+        for window in self.windows:
+            for strip in self._strips_for(window):
+                self.pending[strip] += 1
+        self.strips = {}  # Strip index -> in-memory image, only while tiles are still arriving
+        self.written = {}  # Strip index -> file name
+        self.tiles_pasted = 0
+
+    def _strips_for(self, window):
+        x, y, width, height = window
+        if width <= 0 or height <= 0:
+            return range(0)
+        return range(y // self.strip_height, min(self.num_strips, (y + height - 1) // self.strip_height + 1))
+
+    def _strip_image(self, strip):
+        if strip not in self.strips:
+            rows = min(self.strip_height, self.height - strip * self.strip_height)
+            self.strips[strip] = Image.new('P', (self.width, rows), NODATA_CLASS)
+            self.strips[strip].putpalette(CLASS_PALETTE)
+        return self.strips[strip]
+
+    def add(self, result):
+        """Paste a finished tile into every strip it overlaps and free its image."""
+        sub_img = result.pop('png_image')
+        x, y, width, height = self.windows[result['index']]
+        if width > 0 and height > 0:
+            fitted = _fit_tile(sub_img, width, height)
+            for strip in self._strips_for((x, y, width, height)):
+                self._strip_image(strip).paste(fitted, (x, y - strip * self.strip_height))
+            self.tiles_pasted += 1
+        sub_img.close()
+        self._release(result['index'])
+
+    def skip(self, index):
+        """Account for a tile that failed so the strips it overlaps can still be flushed."""
+        self._release(index)
+
+    def _release(self, index):
+        for strip in self._strips_for(self.windows[index]):
+            self.pending[strip] -= 1
+            if self.pending[strip] == 0:
+                self._write_strip(strip)
+
+    def _write_strip(self, strip):
+        strip_img = self._strip_image(strip)
+        file_name = f"{self.file_prefix}-strip-{strip:04d}.png"
+        strip_img.save(os.path.join(self.output_dir, file_name))
+        strip_img.close()
+        del self.strips[strip]
+        self.written[strip] = file_name
+
+    def close(self):
+        """Free strips still in memory; written strip files stay in the workspace."""
+        for strip_img in self.strips.values():
+            strip_img.close()
+        self.strips = {}
+
+    @METRICS.timed('strip_finish')
+    def finish(self, image_date):
+        """
+        Flush strips that no tile overlapped and return the manifest describing the strip layout,
+        with the workspace 'directory' holding the strip files.
+        """
+        for strip in range(self.num_strips):
+            if strip not in self.written:
+                self._write_strip(strip)
+        manifest = {
+            'image_date': image_date,
+            'width': self.width,
+            'height': self.height,
+            'bounds': list(self.bounds),
+            'strip_height': self.strip_height,
+            'strips': [
+                {'file': self.written[strip], 'row_offset': strip * self.strip_height,
+                 'rows': min(self.strip_height, self.height - strip * self.strip_height)}
+                for strip in range(self.num_strips)
+            ],
+            'legend': class_legend(),
+            'directory': self.output_dir,
+        }
+        return manifest
+
+def class_legend():
+    """Legend entries (class value, label and RGB color) written into output manifests."""
+    return [{'value': value, 'label': label, 'color': list(color)}
+            for value, (label, color) in enumerate(zip(CLASS_LABELS, CLASS_COLORS))]
+
+def mercator_pixel(lon, lat, zoom, tile_size=PYRAMID_TILE_SIZE):
+    """Global Web Mercator pixel coordinates (x, y) of a point at a zoom level."""
+    world = tile_size * 2 ** zoom
+    lat = max(-85.0511, min(85.0511, lat))
+    return (lon + 180) / 360 * world, (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * world
+
+def mercator_latitude(y, zoom, tile_size=PYRAMID_TILE_SIZE):
+    """Latitude of a global Web Mercator pixel row coordinate at a zoom level."""
+    world = tile_size * 2 ** zoom
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world))))
+
+class TilePyramid:
+    """
+    Web Mercator XYZ tile pyramid built incrementally from canvas rows delivered top to bottom.
+    The native zoom is the first whose pixels are no larger than EXPORT_SCALE at the boundary's
+    latitude. Each band of native tiles is rendered as soon as the canvas rows it samples have
+    arrived, then halved into the band above it, so only a few canvas strips and one half-built
+    band per zoom level are held in memory. Tiles are saved as '<z>/<x>/<y>.png' under directory,
+    with NODATA_CLASS transparent; tiles without any data are not written.
+    """
+    def __init__(self, bounds, width_pixels, height_pixels, directory, tile_size=PYRAMID_TILE_SIZE):
+        self.bounds = bounds
+        self.width, self.height = width_pixels, height_pixels
+        self.directory = directory
+        self.tile_size = tile_size
+        minx, miny, maxx, maxy = bounds
+        self.x_scale, self.y_scale = (maxx - minx) / width_pixels, (maxy - miny) / height_pixels
+        pixel_m = EARTH_CIRCUMFERENCE * math.cos(math.radians((miny + maxy) / 2)) / tile_size
+        self.max_zoom = max(0, math.ceil(math.log2(pixel_m / EXPORT_SCALE)))
+
+        # Tile column and row ranges per zoom, halved down to the first zoom covered by a single tile
+        left, top = mercator_pixel(minx, maxy, self.max_zoom, tile_size)
+        right, bottom = mercator_pixel(maxx, miny, self.max_zoom, tile_size)
+        last_tile = 2 ** self.max_zoom - 1
+        self.ranges = {self.max_zoom: (int(left // tile_size), min(last_tile, int(right // tile_size)),
+                                       int(top // tile_size), min(last_tile, int(bottom // tile_size)))}
+        self.min_zoom = self.max_zoom
+        while self.min_zoom > 0:
+            x0, x1, y0, y1 = self.ranges[self.min_zoom]
+            if x0 == x1 and y0 == y1:
+                break
+            self.min_zoom -= 1
+            self.ranges[self.min_zoom] = (x0 >> 1, x1 >> 1, y0 >> 1, y1 >> 1)
+
+        self.strips = []  # (row_offset, image) of canvas rows not yet fully sampled
+        self.rows_received = 0
+        self.next_row = self.ranges[self.max_zoom][2]  # Next native tile row to render
+        self.partial = {}  # Zoom -> (tile row, image) of an overview band still missing its lower half
+        self.tiles = []  # 'z/x/y' of every tile written
+
+    def add_rows(self, row_offset, image):
+        """Accept the next canvas strip (rows must arrive in order) and render every band it completes."""
+        self.strips.append((row_offset, image))
+        self.rows_received = row_offset + image.height
+        self._render_ready()
+
+    def _band_rows(self, tile_row):
+        """Canvas row sampled by each pixel row of a native tile row; out-of-canvas rows are None."""
+        maxy = self.bounds[3]
+        rows = []
+        for y in range(tile_row * self.tile_size, (tile_row + 1) * self.tile_size):
+            row = math.floor((maxy - mercator_latitude(y + 0.5, self.max_zoom, self.tile_size)) / self.y_scale)
+            rows.append(row if 0 <= row < self.height else None)
+        return rows
+
+    def _render_ready(self, final=False):
+        last_row = self.ranges[self.max_zoom][3]
+        while self.next_row <= last_row:
+            rows = self._band_rows(self.next_row)
+            needed = max((row for row in rows if row is not None), default=-1)
+            if needed >= self.rows_received and not final:
+                return
+            self._emit(self.max_zoom, self.next_row, self._render_band(rows))
+            self.next_row += 1
+            # Strips above the first row the next band samples are no longer needed
+            next_rows = [row for row in self._band_rows(self.next_row) if row is not None] if self.next_row <= last_row else []
+            first_needed = min(next_rows, default=self.height)
+            while self.strips and self.strips[0][0] + self.strips[0][1].height <= first_needed:
+                self.strips.pop(0)[1].close()
+
+    def _render_band(self, rows):
+        """Resample one native tile row from the buffered canvas strips."""
+        gathered = Image.new('P', (self.width, self.tile_size), NODATA_CLASS)
+        for y, row in enumerate(rows):
+            for row_offset, strip in self.strips:
+                if row is not None and row_offset <= row < row_offset + strip.height:
+                    gathered.paste(strip.crop((0, row - row_offset, self.width, row - row_offset + 1)), (0, y))
+                    break
+        # Longitude is linear in both grids, so columns are a single affine resampling
+        x0, x1, _, _ = self.ranges[self.max_zoom]
+        world = self.tile_size * 2 ** self.max_zoom
+        lon_step = 360 / world
+        left_lon = x0 * self.tile_size * lon_step - 180
+        band = gathered.transform(
+            ((x1 - x0 + 1) * self.tile_size, self.tile_size), Image.Transform.AFFINE,
+            (lon_step / self.x_scale, 0, (left_lon - self.bounds[0]) / self.x_scale, 0, 1, 0),
+            resample=Image.Resampling.NEAREST, fillcolor=NODATA_CLASS)
+        gathered.close()
+        band.putpalette(CLASS_PALETTE)
+        return band
+
+    def _save_tile(self, zoom, column, tile_row, band):
+        """Crop and save one tile of a band, returning its 'z/x/y' name, or None if it holds no data."""
+        size = self.tile_size
+        offset = (column - self.ranges[zoom][0]) * size
+        tile = band.crop((offset, 0, offset + size, size))
+        try:
+            if tile.histogram()[NODATA_CLASS] == size * size:
+                return None
+            tile_dir = os.path.join(self.directory, str(zoom), str(column))
+            os.makedirs(tile_dir, exist_ok=True)
+            tile.save(os.path.join(tile_dir, f"{tile_row}.png"), transparency=NODATA_CLASS,
+                      compress_level=PYRAMID_COMPRESS_LEVEL)
+            return f"{zoom}/{column}/{tile_row}"
+        finally:
+            tile.close()
+
+    def _emit(self, zoom, tile_row, band):
+        """Save the non-empty tiles of a band and fold the band into the overview above it."""
+        x0, x1, _, _ = self.ranges[zoom]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(PYRAMID_ENCODE_WORKERS, x1 - x0 + 1)) as executor:
+            names = list(executor.map(lambda column: self._save_tile(zoom, column, tile_row, band), range(x0, x1 + 1)))
+        self.tiles.extend(name for name in names if name)
+        if zoom > self.min_zoom:
+            self._add_to_overview(zoom - 1, tile_row, band)
+        band.close()
+
+    def _add_to_overview(self, zoom, child_row, band):
+        parent_row = child_row >> 1
+        if zoom in self.partial and self.partial[zoom][0] != parent_row:
+            self._flush_overview(zoom)
+        if zoom not in self.partial:
+            x0, x1, _, _ = self.ranges[zoom]
+            overview = Image.new('P', ((x1 - x0 + 1) * 2 * self.tile_size, 2 * self.tile_size), NODATA_CLASS)
+            self.partial[zoom] = (parent_row, overview)
+        overview = self.partial[zoom][1]
+        child_x0 = self.ranges[zoom + 1][0]
+        overview.paste(band, ((child_x0 - 2 * self.ranges[zoom][0]) * self.tile_size, (child_row & 1) * self.tile_size))
+        if child_row & 1:
+            self._flush_overview(zoom)
+
+    def _flush_overview(self, zoom):
+        parent_row, overview = self.partial.pop(zoom)
+        band = overview.resize((overview.width // 2, self.tile_size), Image.Resampling.NEAREST)
+        overview.close()
+        band.putpalette(CLASS_PALETTE)
+        self._emit(zoom, parent_row, band)
+
+    def finish(self):
+        """Render the remaining native rows and overview bands once every canvas row has been added."""
+        self._render_ready(final=True)
+        for zoom in range(self.max_zoom - 1, self.min_zoom - 1, -1):
+            if zoom in self.partial:
+                self._flush_overview(zoom)
+        for _, strip in self.strips:
+            strip.close()
+        self.strips = []
+
+class PyramidMosaic(StripMosaic):
+    """
+    Streaming mosaic for the 'tiles' output mode: strips are fed to a TilePyramid in row order as
+    they complete. A strip that completes ahead of an earlier one is spilled to disk until its
+    turn, so memory stays bounded even when tiles finish out of order. Strips no tile overlaps
+    (gaps between the parts of a boundary) are fed blank as soon as they are next.
+    The pyramid renders and encodes on its own thread, so tiles keep being pasted meanwhile; at most
+    PYRAMID_QUEUE_DEPTH strips wait for it before pasting blocks.
+    """
+    def __init__(self, bounds, width_pixels, height_pixels, tiles, output_dir, file_prefix, strip_height=STRIP_HEIGHT):
+        super().__init__(bounds, width_pixels, height_pixels, tiles, output_dir, file_prefix, strip_height=strip_height)
+        self.pyramid = TilePyramid(bounds, width_pixels, height_pixels, os.path.join(output_dir, f"{file_prefix}-tiles"))
+        self.next_strip = 0
+        self.queue = queue.Queue(maxsize=PYRAMID_QUEUE_DEPTH)
+        self.aborted = False
+        self.error = None
+        self.feeder = threading.Thread(target=self._feed_pyramid, name='pyramid-feeder', daemon=True)
+        self.feeder.start()
+        self._feed_ready_strips()
+
+    def _feed_pyramid(self):
+        """Hand queued strips to the pyramid until the end marker; after an error or abort, only free them."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            row_offset, strip_img = item
+            if self.aborted or self.error is not None:
+                strip_img.close()
+                continue
+            try:
+                self.pyramid.add_rows(row_offset, strip_img)
+            except Exception as e:
+                print(f"Error rendering tile pyramid: {e}")
+                self.error = e
+
+    def _stop_feeder(self):
+        if self.feeder.is_alive():
+            self.queue.put(None)
+            self.feeder.join()
+
+    def _write_strip(self, strip):
+        strip_img = self._strip_image(strip)
+        del self.strips[strip]
+        if strip != self.next_strip:
+            file_name = f"{self.file_prefix}-strip-{strip:04d}.png"
+            strip_img.save(os.path.join(self.output_dir, file_name))
+            strip_img.close()
+            self.written[strip] = file_name
+            return
+        self.queue.put((strip * self.strip_height, strip_img))
+        self.next_strip += 1
+        self._feed_ready_strips()
+
+    def _feed_ready_strips(self):
+        """Feed the strips that are next in row order and already complete: spilled ones, and ones no tile overlaps."""
+        while self.next_strip < self.num_strips:
+            strip = self.next_strip
+            if strip in self.written:
+                path = os.path.join(self.output_dir, self.written.pop(strip))
+                with Image.open(path) as spilled:
+                    spilled.load()
+                    self.queue.put((strip * self.strip_height, spilled.copy()))
+                os.remove(path)
+            elif self.pending[strip] == 0:
+                self.queue.put((strip * self.strip_height, self._strip_image(strip)))
+                del self.strips[strip]
+            else:
+                return
+            self.next_strip += 1
+
+    def close(self):
+        """Stop the pyramid thread, dropping strips it has not rendered, and free strips still in memory."""
+        self.aborted = True
+        self._stop_feeder()
+        super().close()
+
+    @METRICS.timed('pyramid_finish')
+    def finish(self, image_date):
+        """Feed strips that no tile overlapped, finish the pyramid and return its manifest."""
+        while self.next_strip < self.num_strips:
+            self._write_strip(self.next_strip)
+        self._stop_feeder()
+        if self.error is not None:
+            raise self.error
+        self.pyramid.finish()
+        manifest = {
+            'image_date': image_date,
+            'bounds': list(self.bounds),
+            'tile_size': self.pyramid.tile_size,
+            'min_zoom': self.pyramid.min_zoom,
+            'max_zoom': self.pyramid.max_zoom,
+            'directory': self.pyramid.directory,
+            'tiles': self.pyramid.tiles,
+            'legend': class_legend(),
+        }
+        return manifest
+
+@METRICS.timed('mosaic_merge')
+def merge_images_properly(canvas, image_date):
+    """Encode the streamed canvas, whose tiles are already masked to the boundary, with a legend as PNG bytes."""
+    return create_final_image_with_legend(canvas.image, image_date)
+
+@METRICS.timed('image_export')
+def process_and_export_image(enhanced_classification, image_date, analysis, progress_callback=None, output_mode='image', deadline=None,
+                             cancel_event=None, composite_id=None):
+    """
+    Split the boundary of an AnalysisContext, process sub-regions concurrently, and stream them into
+    the output mosaic.
+    output_mode 'image' returns the PNG bytes of a single legend image capped at MAX_IMAGE_DIMENSION;
+    'strips' returns the manifest of uncapped full-resolution strips, and 'tiles' the manifest of an
+    uncapped XYZ tile pyramid (see TilePyramid), whose files are written to the workspace.
+    At most TILE_QUEUE_DEPTH tiles are submitted or waiting to be pasted at a time, so fast downloads
+    (or tile cache hits) cannot outrun the mosaic.
+    Setting cancel_event stops the export: queued tiles are dropped, in-flight tiles stop retrying,
+    and None is returned. composite_id (see composite_identity) enables the on-disk tile cache.
+    """
+    bounds = analysis.boundary_box.bounds
+    width_pixels, height_pixels = compute_canvas_size(bounds, max_dimension=None if output_mode in ('strips', 'tiles') else MAX_IMAGE_DIMENSION)
+    transform = canvas_transform(bounds, width_pixels, height_pixels)
+    print(f"Mosaic size: {width_pixels}x{height_pixels} pixels ({output_mode})")
+
+    # Top-to-bottom order lets strips complete (and be freed) while later rows are still downloading
+    sub_rectangles = sorted(split_boundary_box(analysis.boundary, analysis.boundary_box, width_pixels, height_pixels),
+                            key=lambda tile: (tile['window'][1], tile['window'][0]))
+    print(f"Processing {len(sub_rectangles)} sub-rectangles...")
+    if progress_callback:
+        progress_callback('tiles', 0, len(sub_rectangles))
+    process_args = ((i, tile, enhanced_classification, image_date, transform, deadline, cancel_event, composite_id)
+                    for i, tile in enumerate(sub_rectangles))
+
+    if output_mode in ('strips', 'tiles'):
+        center_lat, center_lon = round((bounds[1] + bounds[3]) / 2, 2), round((bounds[0] + bounds[2]) / 2, 2)
+        file_prefix = f"{image_date}-{center_lat:+.2f}{center_lon:+.2f}-natural_forest_classification"
+        mosaic_class = PyramidMosaic if output_mode == 'tiles' else StripMosaic
+        mosaic = mosaic_class(bounds, width_pixels, height_pixels, sub_rectangles, analysis.workspace, file_prefix)
+    else:
+        mosaic = MosaicCanvas(bounds, width_pixels, height_pixels)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(TILE_WORKERS, len(sub_rectangles)))
+    cancelled = False
+    try:
+        try:
+            futures, completed = {}, 0
+            while True:
+                # Top up the queue as tiles are pasted, keeping it in row order
+                for arg in itertools.islice(process_args, TILE_QUEUE_DEPTH - len(futures)):
+                    futures[executor.submit(process_sub_polygon, arg)] = arg[0]
+                if not futures:
+                    break
+                # Poll so a cancellation is noticed even while every tile is still downloading
+                done, _ = concurrent.futures.wait(futures, timeout=CANCEL_POLL_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED)
+                if cancel_event is not None and cancel_event.is_set():
+                    print("Image export cancelled")
+                    cancelled = True
+                    return None
+                for future in sorted(done, key=futures.get):
+                    index = futures.pop(future)
+                    completed += 1
+                    try:
+                        result = future.result()
+                        if result:
+                            mosaic.add(result)
+                            print(f"Processed sub-rectangle {index+1}/{len(sub_rectangles)}")
+                        else:
+                            mosaic.skip(index)
+                    except Exception as e:
+                        print(f"Error processing sub-rectangle: {e}")
+                        mosaic.skip(index)
+                    if progress_callback:
+                        progress_callback('tiles', completed, len(sub_rectangles))
+        finally:
+            executor.shutdown(wait=not cancelled, cancel_futures=cancelled)
+
+        if not mosaic.tiles_pasted:
+            print("No valid sub-rectangle results to merge")
+            return None
+        if output_mode in ('strips', 'tiles'):
+            return mosaic.finish(image_date)
+        return merge_images_properly(mosaic, image_date)
+    finally:
+        # Stops the pyramid thread and frees strips still held when the export is cancelled or fails
+        mosaic.close()
+
+@METRICS.timed('load_boundary')
+def load_boundary(data):
+    """Load the boundary polygon, bounding box and reported area (km²) from the parsed user-uploaded JSON."""
+    json_area = data.get('area', 0)
+    print(f"Area from JSON file: {json_area:.2f} km²")
+    wkt_polygon = data['city_geometry']
+    polygon = wkt.loads(wkt_polygon)
+    boundary_box = box(data['bbox_west'], data['bbox_south'], data['bbox_east'], data['bbox_north'])
+    return polygon, boundary_box, json_area
+
+def load_feature_collection(data, point_buffer_m=DEFAULT_POINT_BUFFER_M):
+    """
+    Load the features of a parsed user-uploaded GeoJSON FeatureCollection.
+    Polygons are analyzed as uploaded, up to simplification (see simplify_boundary); point features
+    (such as geocoded sites) are analyzed over a circle of point_buffer_m meters, which Earth Engine
+    buffers geodesically. The local 'geometry' of a point feature is only an approximation used for
+    scene search. A feature's 'area' property (km²) is used as its total area, like 'area' in
+    single-boundary uploads.
+    """
+    if data.get('type') != 'FeatureCollection':
+        raise ValueError("Batch analysis requires a GeoJSON FeatureCollection")
+
+    features = []
+    for index, feature in enumerate(data.get('features', [])):
+        geometry = shape(feature['geometry']) if feature.get('geometry') else None
+        if geometry is None or geometry.is_empty:
+            print(f"Skipping feature {index}: no geometry")
+            continue
+        properties = feature.get('properties') or {}
+        buffer_m = None
+        if geometry.geom_type == 'Point':
+            if not point_buffer_m or point_buffer_m <= 0:
+                print(f"Skipping feature {index}: point features need a positive point_buffer_m")
+                continue
+            buffer_m = point_buffer_m
+            buffer_deg = point_buffer_m / (111000 * max(math.cos(math.radians(geometry.y)), 0.01))
+            geometry = geometry.buffer(buffer_deg)
+        elif not isinstance(geometry, (Polygon, MultiPolygon)):
+            print(f"Skipping feature {index}: unsupported geometry type {geometry.geom_type}")
+            continue
+        features.append({
+            'feature_index': index,
+            'name': properties.get('name', feature.get('id', f"feature_{index}")),
+            'properties': properties,
+            'geometry': geometry,
+            'point': tuple(shape(feature['geometry']).coords[0]) if buffer_m else None,
+            'buffer_m': buffer_m,
+            'area': properties.get('area'),
+        })
+    if not features:
+        raise ValueError("The FeatureCollection contains no polygon or point features")
+    return features
+
+# --- Boundary Geometry ---
+class BoundaryGeometry:
+    """
+    A boundary prepared once for every use the pipeline makes of it: simplified to BOUNDARY_MAX_ERROR,
+    identified by a compact hash of the simplified geometry, prepared for the repeated window tests
+    of adaptive tiling, and converted to the Earth Engine geometry sent with every request.
+    Instances compare equal by key, so they can be used directly as cache keys.
+    """
+    def __init__(self, polygon):
+        self.polygon = simplify_boundary(polygon)
+        self.key = geometry_key(self.polygon)
+        self.prepared = prep(self.polygon)
+        # Output images keep every pixel inside an exterior ring (see boundary_pixel_rings)
+        parts = self.polygon.geoms if isinstance(self.polygon, MultiPolygon) else [self.polygon]
+        self.shell = unary_union([Polygon(part.exterior) for part in parts])
+        self.prepared_shell = prep(self.shell)
+        self.ee_geometry = shapely_to_ee(self.polygon)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, BoundaryGeometry) and other.key == self.key
+
+_BOUNDARY_CACHE = OrderedDict()  # geometry_key of the uploaded polygon -> BoundaryGeometry, least recently used first
+_BOUNDARY_CACHE_LOCK = threading.Lock()
+
+def prepare_boundary(polygon):
+    """Return the BoundaryGeometry of a polygon, reusing the one built for an identical upload when possible."""
+    key = geometry_key(polygon)
+    with _BOUNDARY_CACHE_LOCK:
+        boundary = _BOUNDARY_CACHE.get(key)
+        if boundary is not None:
+            _BOUNDARY_CACHE.move_to_end(key)
+            return boundary
+    boundary = BoundaryGeometry(polygon)
+    with _BOUNDARY_CACHE_LOCK:
+        _BOUNDARY_CACHE[key] = boundary
+        while len(_BOUNDARY_CACHE) > BOUNDARY_CACHE_SIZE:
+            _BOUNDARY_CACHE.popitem(last=False)
+    return boundary
+
+def geometry_key(geometry):
+    """Compact identity of a geometry: a 128-bit hash of its normalized WKB, so ring order and start vertex do not matter."""
+    return hashlib.blake2b(geometry.normalize().wkb, digest_size=16).hexdigest()
+
+@METRICS.timed('boundary_simplify')
+def simplify_boundary(geometry, max_error_m=BOUNDARY_MAX_ERROR):
+    """
+    Simplify a polygon so that no point moves more than max_error_m meters, keeping it valid.
+    Administrative boundaries often carry far more vertices than STATS_SCALE resolves, and every
+    vertex is sent with each Earth Engine request and clipped against on the server.
+    Returns the geometry unchanged if simplification would leave it empty or invalid.
+    """
+    tolerance = max_error_m / 111000  # A degree of longitude is never longer than one of latitude
+    simplified = geometry.simplify(tolerance, preserve_topology=True)
+    if simplified.is_empty or not simplified.is_valid:
+        return geometry
+    print(f"Simplified boundary from {shapely.get_num_coordinates(geometry)} to {shapely.get_num_coordinates(simplified)} vertices")
+    return simplified
+
+def shapely_to_ee(poly):
+    """Convert a Shapely polygon or multipolygon to an Earth Engine geometry."""
+    if isinstance(poly, MultiPolygon):
+        multi_coords = [[list(p.exterior.coords)] + [list(r.coords) for r in p.interiors] for p in poly.geoms]
+        return ee.Geometry.MultiPolygon(multi_coords)
+    exterior = list(poly.exterior.coords)
+    interiors = [list(r.coords) for r in poly.interiors]
+    return ee.Geometry.Polygon([exterior] + interiors)
+
+def get_protected_areas(boundary, target_date_str):
+    """
+    Build the protected-area mask (1 inside WDPA polygons, 0 elsewhere) for the given BoundaryGeometry and date.
+    The mask is painted from the cached, pre-clipped WDPA geometry of the boundary, so Earth Engine
+    does not filter the global WDPA polygons again for a region it has already seen.
+    Returns (mask, wdpa_release), the release identifying the mask in cache keys (see resolve_wdpa_asset).
+    """
+    dt = datetime.datetime.strptime(target_date_str, '%Y-%m-%d') if isinstance(target_date_str, str) else datetime.datetime.strptime(target_date_str.format('YYYY-MM-dd').getInfo(), '%Y-%m-%d')
+    wdpa_asset, wdpa_release = resolve_wdpa_asset(dt.strftime('%Y%m'))
+    if wdpa_release is None:
+        # The release could not be identified, so nothing built from it is kept
+        return build_protected_area_mask.__wrapped__(boundary, wdpa_asset, None), None
+    return build_protected_area_mask(boundary, wdpa_asset, wdpa_release), wdpa_release
+
+@lru_cache(maxsize=32)
+def build_protected_area_mask(boundary, wdpa_asset, wdpa_release):
+    """Build the protected-area mask of a boundary from one WDPA release."""
+    geometry = get_protected_area_geometry(boundary, wdpa_asset, wdpa_release)
+    if geometry is None:
+        # Too large to send inline; let Earth Engine rasterize the WDPA polygons itself
+        protected = ee.FeatureCollection(wdpa_asset).filterBounds(boundary.ee_geometry).reduceToImage(properties=['WDPAID'], reducer=ee.Reducer.firstNonNull()).gt(0).unmask(0)
+    else:
+        protected = ee.Image(0).byte()
+        if not shape(geometry).is_empty:
+            protected = protected.paint(ee.FeatureCollection([ee.Feature(ee.Geometry(geometry))]), 1)
+    return protected.rename('protected').clip(boundary.ee_geometry)
+
+def resolve_wdpa_asset(yyyymm):
+    """
+    Return (asset_id, release) of the WDPA polygons for a month, falling back to the current release
+    when that month was not published or could not be checked. release identifies the polygons in
+    every cache key built from them: the month itself, or the update time of the current asset,
+    which moves with each new release. It is None when the current release cannot be identified.
+    """
+    try:
+        if wdpa_month_published(yyyymm):
+            return f'WCMC/WDPA/{yyyymm}/polygons', yyyymm
+        print(f"WDPA {yyyymm}/polygons is not available, falling back to current WDPA data")
+    except ee.EEException as e:
+        if EE_SESSION.is_auth_error(e):
+            raise
+        print(f"Error checking WDPA {yyyymm}/polygons ({e}), falling back to current WDPA data")
+    return WDPA_CURRENT_ASSET, current_wdpa_release()
+
+@lru_cache(maxsize=None)
+def wdpa_month_published(yyyymm):
+    """
+    Return whether the WDPA polygons of a month were published. Constructing an ee.FeatureCollection
+    never fails for a missing asset, so its existence is checked with one metadata call. Published
+    releases never change, so the answer is kept for the container's lifetime; any other error is
+    raised, and so is not cached.
+    """
+    try:
+        ee.data.getAsset(f'WCMC/WDPA/{yyyymm}/polygons')
+    except ee.EEException as e:
+        if EE_SESSION.is_auth_error(e) or not WDPA_NOT_FOUND_PATTERN.search(str(e)):
+            raise
+        return False
+    print(f"Using WDPA {yyyymm}/polygons")
+    return True
+
+def current_wdpa_release():
+    """Release of WDPA_CURRENT_ASSET, re-read at most once per WDPA_CURRENT_TTL; None if it cannot be identified."""
+    try:
+        return _current_wdpa_release(int(time.time() // WDPA_CURRENT_TTL))
+    except ee.EEException as e:
+        if EE_SESSION.is_auth_error(e):
+            raise
+        print(f"Error reading the current WDPA release: {e}")
+        return None
+
+@lru_cache(maxsize=1)
+def _current_wdpa_release(period):
+    update_time = ee.data.getAsset(WDPA_CURRENT_ASSET).get('updateTime')
+    return f"current@{update_time}" if update_time else None
+
+def protected_area_cache_key(boundary, wdpa_release):
+    """Hash the boundary's geometry key, the WDPA release and the simplification tolerance."""
+    payload = json.dumps({
+        'geometry': boundary.key,
+        'wdpa_release': wdpa_release,
+        'max_error': PROTECTED_AREA_MAX_ERROR,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+@METRICS.timed('protected_areas')
+def get_protected_area_geometry(boundary, wdpa_asset, wdpa_release):
+    """
+    Return the GeoJSON geometry of the WDPA polygons inside a boundary, clipped, dissolved and
+    simplified on the server. Geometries are cached in /tmp and in S3 under the boundary hash and
+    WDPA release, so each region is only computed once per release; nothing is cached when the
+    release is unknown. Returns None if the geometry is larger than PROTECTED_AREA_MAX_BYTES or
+    could not be computed.
+    """
+    cache_key = protected_area_cache_key(boundary, wdpa_release) if wdpa_release else None
+    local_path = os.path.join(PROTECTED_AREA_CACHE_DIR, f"{cache_key}.geojson") if cache_key else None
+    s3_key = f"{PROTECTED_AREA_CACHE_PREFIX}/{cache_key}.geojson" if cache_key else None
+
+    if local_path and os.path.exists(local_path):
+        print(f"Protected-area geometry found in local cache: {cache_key}")
+        with open(local_path, 'rb') as f:
+            body = f.read()
+    else:
+        body = None
+        if s3_key:
+            try:
+                body = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)['Body'].read()
+                print(f"Protected-area geometry found in S3 cache: {cache_key}")
+            except s3.exceptions.NoSuchKey:
+                pass
+            except Exception as e:
+                print(f"Error reading protected-area cache: {e}")
+
+        if body is None:
+            body = compute_protected_area_geometry(boundary, wdpa_asset)
+            if body is None:
+                return None
+            if s3_key:
+                try:
+                    s3.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=body, ContentType='application/geo+json')
+                except Exception as e:
+                    print(f"Error storing protected-area geometry in cache: {e}")
+
+        if local_path:
+            os.makedirs(PROTECTED_AREA_CACHE_DIR, exist_ok=True)
+            temp_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(body)
+            os.replace(temp_path, local_path)  # Never expose a half-written file to concurrent readers
+
+    if len(body) > PROTECTED_AREA_MAX_BYTES:
+        print(f"Protected-area geometry is {len(body)} bytes, too large to send inline")
+        return None
+    return json.loads(body)
+
+def compute_protected_area_geometry(boundary, wdpa_asset):
+    """
+    Clip, dissolve and simplify the WDPA polygons inside a boundary on the server and return them as
+    GeoJSON bytes, or None if Earth Engine fails to (for example on too many or too complex polygons).
+    """
+    print(f"Computing protected-area geometry from {wdpa_asset}")
+    geometry = (ee.FeatureCollection(wdpa_asset).filterBounds(boundary.ee_geometry)
+                .geometry(PROTECTED_AREA_MAX_ERROR)
+                .dissolve(PROTECTED_AREA_MAX_ERROR)
+                .intersection(boundary.ee_geometry, PROTECTED_AREA_MAX_ERROR)
+                .simplify(PROTECTED_AREA_MAX_ERROR))
+    try:
+        return json.dumps(geometry.getInfo()).encode('utf-8')
+    except Exception as e:
+        if EE_SESSION.is_auth_error(e):
+            raise
+        print(f"Error computing protected-area geometry, rasterizing on the server instead: {e}")
+        return None
+
+@METRICS.timed('legend_render')
+def create_final_image_with_legend(map_img, image_date):
+    """
+    Add a legend to the classified image and return it encoded as PNG, kept in memory for upload.
+    The image stays in 'P' mode, with the legend drawn in palette indices, so the final
+    image costs one byte per pixel instead of three.
+    """
+    labels = CLASS_LABELS
+    map_width, map_height = map_img.size
+    legend_width, legend_height = 200, len(labels) * 50 + 20
+    final_width, final_height = map_width + legend_width + 20, max(map_height, legend_height) + 60
+    
+    final_img = Image.new('P', (final_width, final_height), LEGEND_BACKGROUND)
+    final_img.putpalette(CLASS_PALETTE)
+    final_img.paste(map_img, (10, 50))
+    draw = ImageDraw.Draw(final_img)
+    draw.text((10, 10), f"Natural Forest Classification ({image_date})", fill=NODATA_CLASS)
+    
+    legend_x, legend_y = map_width + 20, 50
+    for i, label in enumerate(labels):
+        rect_y = legend_y + i * 30
+        draw.rectangle([legend_x, rect_y, legend_x + 20, rect_y + 20], fill=i)
+        draw.text((legend_x + 30, rect_y + 5), label, fill=NODATA_CLASS)
+    
+    buffer = io.BytesIO()
+    final_img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@METRICS.timed('area_statistics')
+def calculate_area_statistics(image, boundary, total_area, image_date):
+    """Calculate land cover statistics for a boundary."""
+    histogram = class_histogram(image, boundary).getInfo() or {}
+    return build_area_statistics(histogram, total_area, image_date)
+
+def class_histogram(image, boundary):
+    """Server-side class frequency histogram of the classification image over a boundary."""
+    return image.reduceRegion(reducer=ee.Reducer.frequencyHistogram(), geometry=boundary, scale=STATS_SCALE, maxPixels=1e13, bestEffort=True, tileScale=4).get('classification')
+
+@METRICS.timed('feature_statistics')
+def calculate_feature_statistics(image, features, image_date):
+    """
+    Calculate land cover statistics for every feature with one grouped reduceRegions evaluation.
+    Feature areas missing from the upload are computed on the server in the same request.
+    """
+    def to_ee_geometry(feature):
+        if feature['buffer_m']:
+            return ee.Geometry.Point(list(feature['point'])).buffer(feature['buffer_m'])
+        return shapely_to_ee(simplify_boundary(feature['geometry']))
+
+    ee_features = ee.FeatureCollection([
+        ee.Feature(to_ee_geometry(feature), {'feature_index': feature['feature_index']})
+        for feature in features
+    ]).map(lambda feature: feature.set('area_km2', feature.geometry().area(1).divide(1e6)))
+    reduced = image.reduceRegions(collection=ee_features, reducer=ee.Reducer.frequencyHistogram(), scale=STATS_SCALE, tileScale=4)
+    rows = reduced.select(['feature_index', 'area_km2', 'histogram'], None, False).getInfo()['features']
+    reduced_by_index = {row['properties']['feature_index']: row['properties'] for row in rows}
+
+    feature_stats = []
+    for feature in features:
+        reduced_feature = reduced_by_index.get(feature['feature_index'], {})
+        total_area = feature['area'] if feature['area'] is not None else reduced_feature.get('area_km2', 0)
+        feature_stats.append({
+            'feature_index': feature['feature_index'],
+            'name': feature['name'],
+            'properties': feature['properties'],
+            'buffer_m': feature['buffer_m'],
+            **build_area_statistics(reduced_feature.get('histogram') or {}, total_area, image_date),
+        })
+    return feature_stats
+
+def build_area_statistics(histogram, total_area, image_date):
+    """Turn a class frequency histogram into the land cover statistics reported to the client."""
+    CLASS_NAMES = ['water', 'trees', 'grass', 'flooded_vegetation', 'crops', 'shrub_and_scrub', 'built', 'bare', 'snow_and_ice', 'cloud', 'natural_forest']
+    class_pixels, total_pixels = {}, 0
+    for class_value, pixel_count in histogram.items():
+        class_idx = int(class_value)
+        if class_idx < len(CLASS_NAMES):
+            class_pixels[CLASS_NAMES[class_idx]] = pixel_count
+            total_pixels += pixel_count
+    
+    class_areas = {name: round((pixels / total_pixels) * total_area, 5) if total_pixels > 0 else 0.0 for name, pixels in class_pixels.items()}
+    for name in CLASS_NAMES:
+        if name not in class_areas:
+            class_areas[name] = 0.0
+    
+    natural_forest_area, trees_area = class_areas['natural_forest'], class_areas['trees']
+    total_forest_area = natural_forest_area + trees_area
+    stats_data = {
+        "date": image_date,
+        "total_area_km2": round(total_area, 5),
+        "forest_area_km2": round(total_forest_area, 5),
+        "natural_forest_km2": round(natural_forest_area, 5),
+        "natural_forest_percentage": round((natural_forest_area / total_forest_area) * 100, 5) if total_forest_area > 0 else 0,
+        "other_trees_km2": round(trees_area, 5),
+        "other_trees_percentage": round((trees_area / total_forest_area) * 100, 5) if total_forest_area > 0 else 0,
+        "land_cover_classes": {name: {"area_km2": round(area, 5), "percentage": round((area / total_area) * 100, 5) if total_area > 0 else 0} 
+                               for name, area in sorted(class_areas.items(), key=lambda x: x[1], reverse=True) if area > 0}
+    }
+    return stats_data
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Long-running entry point that serves the forest classification API from one warm process.
+Requests arrive over HTTP with the same JSON bodies as the Lambda function URL and are routed by
+lambda_function.handle_request, so every operation behaves as it does on Lambda. Earth Engine
+operations and background jobs run on a bounded thread pool and share the process's Earth Engine
+session, tile connection pool and caches. Needs the same environment variables as the Lambda.
+
+    python worker.py --port 8080 --concurrency 4
+"""
+import argparse
+import concurrent.futures
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lambda_function
+
+# --- Worker Settings ---
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '4'))  # Analyses run at the same time
+WORKER_REQUEST_TIMEOUT = int(os.environ.get('WORKER_REQUEST_TIMEOUT', '900'))  # Seconds one analysis may take, like the Lambda timeout
+WORKER_METRICS_INTERVAL = 60  # Seconds between emissions of the worker's aggregated metrics
+PIPELINE_OPERATIONS = ('analysis', 'batch_analysis', 'timeseries')  # Operations run on the analysis pool
+
+class WorkerContext:
+    """
+    Stands in for the Lambda context of one request: the remaining time counts down from the
+    worker's request timeout, and submitted jobs run on the worker's pool instead of a new invocation.
+    """
+    def __init__(self, worker, timeout_s):
+        self.worker = worker
+        self._deadline = time.monotonic() + timeout_s
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+    def run_in_background(self, job_id):
+        self.worker.submit_job(job_id)
+
+class AnalysisWorker:
+    """
+    Serves API events from one process. Pipeline operations and jobs run on a pool of concurrency
+    threads, each with its own AnalysisContext; uploads, job polling and CORS preflights are answered
+    on the caller's thread. Metrics are process-wide here, so they are emitted on an interval
+    rather than per request.
+    """
+    def __init__(self, concurrency=WORKER_CONCURRENCY, request_timeout=WORKER_REQUEST_TIMEOUT):
+        self.request_timeout = request_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='analysis')
+        # Import the pipeline up front and size the shared tile connection pool for every concurrent analysis
+        pipeline = lambda_function.load_pipeline()
+        pipeline.HTTP_SESSION = pipeline._build_http_session(pipeline.TILE_WORKERS * concurrency)
+        self._metrics_lock = threading.Lock()
+        self._last_emit = time.monotonic()
+
+    def handle(self, event):
+        """Route one API event and return its Lambda-style response."""
+        try:
+            operation = lambda_function.parse_request_body(event).get('operation', '').lower()
+        except Exception:
+            operation = ''  # handle_request reports the malformed body
+        context = WorkerContext(self, self.request_timeout)
+        if operation in PIPELINE_OPERATIONS:
+            response = self.executor.submit(lambda_function.handle_request, event, context).result()
+        else:
+            response = lambda_function.handle_request(event, context)
+        self.emit_metrics()
+        return response
+
+    def submit_job(self, job_id):
+        """Run a submitted background job on the analysis pool."""
+        self.executor.submit(self._run_job, job_id)
+
+    def _run_job(self, job_id):
+        lambda_function.run_job(job_id, WorkerContext(self, self.request_timeout))
+        self.emit_metrics()
+
+    def emit_metrics(self, force=False):
+        """Emit and reset the aggregated metrics once WORKER_METRICS_INTERVAL has passed, or now if forced."""
+        with self._metrics_lock:
+            if not force and time.monotonic() - self._last_emit < WORKER_METRICS_INTERVAL:
+                return
+            self._last_emit = time.monotonic()
+            lambda_function.METRICS.set_dimension('Operation', 'worker')
+            lambda_function.METRICS.emit()
+            lambda_function.METRICS.reset()
+
+    def shutdown(self):
+        """Wait for running analyses and jobs, then flush the metrics."""
+        self.executor.shutdown(wait=True)
+        self.emit_metrics(force=True)
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Turns each HTTP request into a function URL style event for the server's AnalysisWorker."""
+    protocol_version = 'HTTP/1.1'
+
+    def _serve(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        event = {
+            'httpMethod': self.command,
+            'headers': dict(self.headers),
+            'body': self.rfile.read(length).decode('utf-8') if length else None,
+        }
+        response = self.server.worker.handle(event)
+        payload = (response.get('body') or '').encode('utf-8')
+        self.send_response(response.get('statusCode', 200))
+        for name, value in response.get('headers', {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_OPTIONS = _serve
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, help='analyses run at the same time')
+    parser.add_argument('--request-timeout', type=int, default=WORKER_REQUEST_TIMEOUT, help='seconds one analysis may take')
+    args = parser.parse_args()
+
+    worker = AnalysisWorker(args.concurrency, args.request_timeout)
+    server = ThreadingHTTPServer((args.host, args.port), _RequestHandler)
+    server.worker = worker
+    print(f"Serving on {args.host}:{args.port} with {args.concurrency} concurrent analyses")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        worker.shutdown()
+
+if __name__ == '__main__':
+    main()
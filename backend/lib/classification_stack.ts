@@ -122,17 +122,21 @@ export class ForestClassificationStack extends cdk.Stack {
       code: lambda.Code.fromBucket(assetsBucket, 'lambda-function-code.zip'),
       memorySize: 10240,
       timeout: cdk.Duration.seconds(900),
+      retryAttempts: 0, // A timed-out background job is reported as failed, not run again
+      ephemeralStorageSize: cdk.Size.gibibytes(4), // Half of /tmp backs the tile cache
       environment: {
         S3_BUCKET: bucket.bucketName,
         ASSETS_BUCKET: assetsBucketName,
         EE_KEY_S3_KEY: geeCredentialsFile,
-        EE_KEY_PATH: '/tmp/ee-key.json',
-        DATA_PATH: '/tmp/data.json',
         OUTPUT_PREFIX: 'forest_classification',
         UPLOAD_EXPIRATION: '3600',
         DOWNLOAD_EXPIRATION: '86400',
         ALLOWED_ORIGINS: '*',
         DEBUG: 'false',
+        RESULT_CACHE_ENABLED: 'true',
+        RESULT_CACHE_TTL: '604800',
+        RESULT_CACHE_MAX_BYTES: '5368709120',
+        METRICS_ENABLED: 'true',
       },
       layers: [earthEngineLayer, imageProcessingLayer],
     });
@@ -151,6 +155,17 @@ export class ForestClassificationStack extends cdk.Stack {
       })
     );
 
+    // Allow the function to start background analysis jobs by invoking itself asynchronously.
+    // A standalone policy avoids a circular dependency between the function and its role.
+    new iam.Policy(this, 'ForestClassificationSelfInvokePolicy', {
+      statements: [
+        new iam.PolicyStatement({
+          actions: ['lambda:InvokeFunction'],
+          resources: [forestClassificationLambda.functionArn],
+        }),
+      ],
+    }).attachToRole(forestClassificationLambda.role!);
+
     // Create IAM role for AmplifyDeployer Lambda
     const amplifyDeployerRole = new iam.Role(this, 'AmplifyDeployerRole', {
       assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),